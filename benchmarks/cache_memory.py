@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""Compare the memory used per entry by the cache backends.
+
+    $ PYTHONPATH=. python3 benchmarks/cache_memory.py 200000
+"""
+
+import gc
+import sys
+import tracemalloc
+
+from geocode.cache import GeocodeCache
+from geocode.compact import CompactGeocodeCache
+
+
+def make_value(i):
+    # Mimic the values produced by the services. Coordinates arrive as strings.
+    return {"location": {"lat": str(37.0 + i * 1e-6), "lng": str(-122.0 - i * 1e-6)},
+            "served_by": "HERE" if i % 2 else "google"}
+
+
+def measure(factory, count):
+    # Keys are created up front as every backend has to hold them.
+    keys = ["{}+Main+St+Springfield".format(i) for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    cache = factory(count)
+    for i, key in enumerate(keys):
+        cache.put(key, make_value(i))
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / count
+
+
+def main(argv):
+    count = int(argv[0]) if argv else 100000
+    backends = (("dict", lambda n: GeocodeCache(max_entries=n)),
+                ("compact", lambda n: CompactGeocodeCache(max_entries=n)))
+    for name, factory in backends:
+        print("{:8} {:8.1f} bytes/entry".format(name, measure(factory, count)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+
+class AdmissionController(object):
+    """Bounds the number of requests being worked on at once.
+
+    Up to `max_in_flight` callers may hold a slot. Up to `max_queued`
+    more wait for at most `queue_timeout` seconds for one to be
+    released. Anyone else is turned away immediately so callers fail
+    fast rather than piling up behind a slow service.
+    """
+    def __init__(self, max_in_flight=32, max_queued=64, queue_timeout=0.5,
+                 retry_after=1, bypass=True, clock=time.monotonic):
+        if max_in_flight <= 0 or max_queued < 0 or queue_timeout < 0:
+            raise ValueError("max_in_flight must be positive, "
+                             "max_queued and queue_timeout cannot be negative")
+        self._max_in_flight = max_in_flight
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self._retry_after = retry_after
+        self._bypass = bypass
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._shed = 0
+        self._timed_out = 0
+        self._bypassed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a controller from the "admission" section of the configuration."""
+        keys = ("max_in_flight", "max_queued", "queue_timeout", "retry_after", "bypass")
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    @property
+    def retry_after(self):
+        """Seconds a rejected caller is asked to wait before retrying."""
+        return self._retry_after
+
+    @property
+    def bypass_enabled(self):
+        """True if requests that need no lookup may skip admission."""
+        return self._bypass
+
+    def acquire(self):
+        """Take a slot. Returns False if the request should be shed."""
+        with self._cond:
+            if self._in_flight < self._max_in_flight:
+                self._in_flight += 1
+                self._admitted += 1
+                return True
+            if self._queued >= self._max_queued:
+                self._shed += 1
+                return False
+
+            self._queued += 1
+            try:
+                deadline = self._clock() + self._queue_timeout
+                while self._in_flight >= self._max_in_flight:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if self._in_flight < self._max_in_flight:
+                            break
+                        self._shed += 1
+                        self._timed_out += 1
+                        return False
+            finally:
+                self._queued -= 1
+            self._in_flight += 1
+            self._admitted += 1
+            return True
+
+    def release(self):
+        """Give back a slot taken by `acquire`."""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def bypassed(self):
+        """Count a request which skipped admission."""
+        with self._cond:
+            self._bypassed += 1
+
+    def stats(self):
+        """Return a dict of the current depth and counters."""
+        with self._cond:
+            return {"in_flight": self._in_flight,
+                    "max_in_flight": self._max_in_flight,
+                    "queued": self._queued,
+                    "max_queued": self._max_queued,
+                    "admitted": self._admitted,
+                    "shed": self._shed,
+                    "timed_out": self._timed_out,
+                    "bypassed": self._bypassed}
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+
+
+DROP = "drop"
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Hands log records to a background thread through a bounded queue.
+
+    Pair with a `logging.handlers.QueueListener` which does the actual
+    I/O. When the queue is full `overflow` decides what happens:
+
+    `DROP` discards the new record, `DROP_OLDEST` discards the oldest
+    queued record to make room and `BLOCK` waits for space.
+
+    Records are queued as they are. Message formatting happens in the
+    listener thread so arguments must not be changed after logging.
+    """
+    def __init__(self, maxsize=10000, overflow=DROP):
+        if overflow not in (DROP, DROP_OLDEST, BLOCK):
+            raise ValueError("unknown overflow policy: {}".format(overflow))
+        super().__init__(queue.Queue(maxsize))
+        self._overflow = overflow
+        self._dropped = 0
+
+    @property
+    def dropped(self):
+        """Number of records discarded because the queue was full."""
+        return self._dropped
+
+    def handle(self, record):
+        # `logging.Handler.handle` holds the handler lock around `emit`.
+        # The queue is already thread safe and with `BLOCK` a full queue
+        # would keep every thread that logs waiting on that lock.
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self._overflow == BLOCK:
+            self.queue.put(record)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                self._dropped += 1
+                if self._overflow == DROP:
+                    return
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def stats(self):
+        """Return a dict describing the queue."""
+        return {"queued": self.queue.qsize(),
+                "max_queued": self.queue.maxsize,
+                "dropped": self._dropped}
+
+
+class SamplingFilter(logging.Filter):
+    """Only lets through a `rate` fraction of DEBUG records.
+
+    Records above DEBUG are never filtered.
+    """
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self._every = max(int(round(1.0 / rate)), 1) if rate > 0 else 0
+        self._counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if not self._every:
+            return False
+        return next(self._counter) % self._every == 0
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats access records as a single line of JSON.
+
+    A record is an access record if it was logged with an `access` dict
+    in `extra`. Everything else uses the normal format.
+    """
+    def format(self, record):
+        fields = getattr(record, "access", None)
+        if fields is None:
+            return super().format(record)
+        js = {"time": self.formatTime(record), "type": "access"}
+        js.update(fields)
+        return json.dumps(js)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class BulkheadFull(Exception):
+    """Raised when a bulkhead has no room for more work."""
+    pass
+
+
+class Bulkhead(object):
+    """A bounded pool of threads reserved for calls to one service.
+
+    At most `max_concurrent` calls run at once and at most `max_queued`
+    more wait for a thread. Anything beyond that is refused straight
+    away so a slow service cannot tie up every caller.
+    """
+    def __init__(self, name, max_concurrent=4, max_queued=0):
+        if max_concurrent <= 0 or max_queued < 0:
+            raise ValueError("max_concurrent must be positive, max_queued cannot be negative")
+        self._name = name
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent,
+                                            thread_name_prefix="bulkhead-{}".format(name))
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+
+    @classmethod
+    def from_config(cls, name, config):
+        """Create a bulkhead from a service's entry in the "bulkheads" configuration."""
+        keys = ("max_concurrent", "max_queued")
+        return cls(name, **{key: config[key] for key in keys if key in config})
+
+    @property
+    def capacity(self):
+        """How many calls may run or wait at once."""
+        return self._max_concurrent + self._max_queued
+
+    def submit(self, fn, *args):
+        """Run `fn(*args)` in the pool. Returns a `Future`.
+
+        Raises `BulkheadFull` if the pool and its queue are full.
+        """
+        with self._lock:
+            if self._pending >= self.capacity:
+                self._rejected += 1
+                raise BulkheadFull(self._name)
+            self._pending += 1
+        return self._executor.submit(self._run, fn, args)
+
+    def _run(self, fn, args):
+        with self._lock:
+            self._active += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._pending -= 1
+                self._completed += 1
+
+    def stats(self):
+        """Return a dict describing the occupancy of the pool."""
+        with self._lock:
+            return {"active": self._active,
+                    "queued": self._pending - self._active,
+                    "max_concurrent": self._max_concurrent,
+                    "max_queued": self._max_queued,
+                    "completed": self._completed,
+                    "rejected": self._rejected}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
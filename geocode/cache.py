@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import threading
+import time
+
+
+FRESH = "fresh"
+REFRESH = "refresh"
+STALE = "stale"
+EXPIRED = "expired"
+
+
+class GeocodeCache(object):
+    """In-memory cache of lookup results.
+
+    An entry is fresh for `ttl` seconds after it is stored. After that
+    it is stale for a further `stale_ttl` seconds and may still be
+    served while it is refreshed. Once that window passes the entry is
+    expired. Expired entries are kept until evicted so they can be
+    served as a last resort when every service is failing.
+
+    A fresh entry which has been read at least `refresh_min_hits` times
+    and is within the final `refresh_ahead` fraction of its `ttl` is
+    reported as needing a refresh so popular entries never go stale.
+
+    The least recently used entry is evicted once `max_entries` is
+    reached.
+    """
+    def __init__(self, ttl=86400, stale_ttl=3600, max_entries=100000,
+                 refresh_ahead=0.1, refresh_min_hits=5, clock=time.monotonic):
+        if ttl <= 0 or stale_ttl < 0 or max_entries <= 0:
+            raise ValueError("ttl and max_entries must be positive, stale_ttl cannot be negative")
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._max_entries = max_entries
+        self._refresh_at = ttl * (1.0 - refresh_ahead)
+        self._refresh_min_hits = refresh_min_hits
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> [value, stored_at, hits]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a cache from the "cache" section of the configuration."""
+        keys = ("ttl", "stale_ttl", "max_entries", "refresh_ahead", "refresh_min_hits")
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return a tuple of the cached value and its state.
+
+        The state is one of `FRESH`, `REFRESH`, `STALE` or
+        `EXPIRED`. `(None, None)` is returned on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            self._entries.move_to_end(key)
+            entry[2] += 1
+            age = self._clock() - entry[1]
+            hits = entry[2]
+
+        if age < self._refresh_at:
+            return entry[0], FRESH
+        elif age < self._ttl:
+            if hits >= self._refresh_min_hits:
+                return entry[0], REFRESH
+            return entry[0], FRESH
+        elif age < self._ttl + self._stale_ttl:
+            return entry[0], STALE
+        return entry[0], EXPIRED
+
+    def peek(self, key):
+        """Return the cached value if it can be served without a lookup.
+
+        Does not count as a hit. Expired entries are not returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._clock() - entry[1] >= self._ttl + self._stale_ttl:
+                return None
+            return entry[0]
+
+    def put(self, key, value):
+        """Store `value` for `key`, resetting its age.
+
+        The hit count is kept so a refreshed popular entry stays popular.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            hits = entry[2] if entry is not None else 0
+            self._entries[key] = [value, self._clock(), hits]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def dump(self):
+        """Return a list of `(key, value, age)` for every entry.
+
+        Used to write a snapshot which `load` can restore.
+        """
+        with self._lock:
+            now = self._clock()
+            return [(key, entry[0], now - entry[1]) for key, entry in self._entries.items()]
+
+    def load(self, entries):
+        """Add `(key, value, age)` entries as produced by `dump`.
+
+        Returns the number of entries loaded.
+        """
+        count = 0
+        with self._lock:
+            now = self._clock()
+            for key, value, age in entries:
+                self._entries[key] = [value, now - max(age, 0), 0]
+                self._entries.move_to_end(key)
+                count += 1
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return count
+
+    def stats(self):
+        """Return a dict describing the cache contents."""
+        return {"entries": len(self._entries), "max_entries": self._max_entries}
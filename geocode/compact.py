@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+from array import array
+import threading
+import time
+
+from geocode.cache import FRESH, REFRESH, STALE, EXPIRED
+
+
+class CompactGeocodeCache(object):
+    """Memory efficient drop in replacement for `GeocodeCache`.
+
+    Rather than keeping a dict per result the coordinates, timestamps
+    and hit counts live in preallocated `array` slabs indexed by a slot
+    number. Service names are stored as small integer IDs with 0
+    meaning the location was not found. The result dict is only rebuilt
+    when an entry is read.
+
+    Eviction uses the CLOCK algorithm over the slots so no memory is
+    allocated when an entry is replaced.
+
+    Coordinates are kept as doubles so a value such as "37.42240820"
+    is returned as "37.4224082".
+    """
+    def __init__(self, ttl=86400, stale_ttl=3600, max_entries=100000,
+                 refresh_ahead=0.1, refresh_min_hits=5, clock=time.monotonic):
+        if ttl <= 0 or stale_ttl < 0 or max_entries <= 0:
+            raise ValueError("ttl and max_entries must be positive, stale_ttl cannot be negative")
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._max_entries = max_entries
+        self._refresh_at = ttl * (1.0 - refresh_ahead)
+        self._refresh_min_hits = refresh_min_hits
+        self._clock = clock
+
+        self._lat = array("d", bytes(8 * max_entries))
+        self._lng = array("d", bytes(8 * max_entries))
+        self._stored = array("d", bytes(8 * max_entries))
+        self._hits = array("I", bytes(4 * max_entries))
+        self._served_by = array("B", bytes(max_entries))
+        self._referenced = array("B", bytes(max_entries))
+        self._keys = [None] * max_entries
+        self._index = {}  # key -> slot
+        self._hand = 0
+
+        self._providers = [None]  # ID 0 is "not found"
+        self._provider_ids = {}
+
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a cache from the "cache" section of the configuration."""
+        keys = ("ttl", "stale_ttl", "max_entries", "refresh_ahead", "refresh_min_hits")
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    def __len__(self):
+        return len(self._index)
+
+    def _value(self, slot):
+        provider = self._served_by[slot]
+        if not provider:
+            return {}
+        return {"location": {"lat": repr(self._lat[slot]), "lng": repr(self._lng[slot])},
+                "served_by": self._providers[provider]}
+
+    def _provider_id(self, name):
+        provider = self._provider_ids.get(name)
+        if provider is None:
+            if len(self._providers) > 255:
+                raise ValueError("too many services to intern: {}".format(name))
+            provider = len(self._providers)
+            self._providers.append(name)
+            self._provider_ids[name] = provider
+        return provider
+
+    def _slot_for(self, key):
+        """Return the slot for `key`, evicting another entry if needed."""
+        slot = self._index.get(key)
+        if slot is not None:
+            return slot
+
+        if len(self._index) < self._max_entries:
+            slot = len(self._index)
+        else:
+            referenced = self._referenced
+            hand = self._hand
+            while referenced[hand]:
+                referenced[hand] = 0
+                hand = (hand + 1) % self._max_entries
+            slot = hand
+            self._hand = (hand + 1) % self._max_entries
+            del self._index[self._keys[slot]]
+
+        self._index[key] = slot
+        self._keys[slot] = key
+        self._hits[slot] = 0
+        return slot
+
+    def _pack(self, value):
+        """Return `value` as a tuple of latitude, longitude and service ID."""
+        if not value:
+            return 0.0, 0.0, 0
+        try:
+            location = value["location"]
+            return (float(location["lat"]), float(location["lng"]),
+                    self._provider_id(value["served_by"]))
+        except (KeyError, TypeError) as e:
+            raise ValueError("cannot pack {!r}: {}".format(value, e))
+
+    def _store(self, slot, packed, stored_at):
+        self._lat[slot], self._lng[slot], self._served_by[slot] = packed
+        self._stored[slot] = stored_at
+        self._referenced[slot] = 1
+
+    def get(self, key):
+        """Return a tuple of the cached value and its state.
+
+        See `GeocodeCache.get`.
+        """
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None:
+                return None, None
+            self._referenced[slot] = 1
+            if self._hits[slot] < 0xFFFFFFFF:
+                self._hits[slot] += 1
+            age = self._clock() - self._stored[slot]
+            hits = self._hits[slot]
+            value = self._value(slot)
+
+        if age < self._refresh_at:
+            return value, FRESH
+        elif age < self._ttl:
+            if hits >= self._refresh_min_hits:
+                return value, REFRESH
+            return value, FRESH
+        elif age < self._ttl + self._stale_ttl:
+            return value, STALE
+        return value, EXPIRED
+
+    def peek(self, key):
+        """Return the cached value if it can be served without a lookup."""
+        with self._lock:
+            slot = self._index.get(key)
+            if slot is None or self._clock() - self._stored[slot] >= self._ttl + self._stale_ttl:
+                return None
+            return self._value(slot)
+
+    def put(self, key, value):
+        """Store `value` for `key`, resetting its age."""
+        with self._lock:
+            packed = self._pack(value)
+            self._store(self._slot_for(key), packed, self._clock())
+
+    def dump(self):
+        """Return a list of `(key, value, age)` for every entry."""
+        with self._lock:
+            now = self._clock()
+            return [(key, self._value(slot), now - self._stored[slot])
+                    for key, slot in self._index.items()]
+
+    def load(self, entries):
+        """Add `(key, value, age)` entries as produced by `dump`."""
+        count = 0
+        with self._lock:
+            now = self._clock()
+            for key, value, age in entries:
+                packed = self._pack(value)
+                slot = self._slot_for(key)
+                self._store(slot, packed, now - max(age, 0))
+                self._referenced[slot] = 0
+                count += 1
+        return count
+
+    def stats(self):
+        """Return a dict describing the cache contents."""
+        return {"entries": len(self._index), "max_entries": self._max_entries}
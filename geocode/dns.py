@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import functools
+import http.client
+import logging
+import socket
+import threading
+import time
+import urllib.request as request
+
+
+logger = logging.getLogger("")
+
+
+def system_resolver(host, port):
+    """Resolve `host` with the system resolver.
+
+    Returns a tuple of the addresses and a TTL. The system resolver
+    does not report TTLs so the TTL is always None.
+    """
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = list(OrderedDict.fromkeys(info[4][0] for info in infos))
+    return addresses, None
+
+
+class ResolverCache(object):
+    """Caches the addresses of the hosts the services run on.
+
+    `resolver` is called as `resolver(host, port)` and returns a tuple
+    of addresses and a TTL in seconds. When it gives no TTL `ttl` is
+    used. Once `prefetch` of an entry's TTL has passed it is resolved
+    again in the background so requests do not wait on the resolver.
+    If resolving fails the old addresses stay in use.
+
+    Each call to `addresses` rotates the order so connections are
+    spread across the hosts. An address which failed to connect is
+    tried last until the entry is resolved again.
+    """
+    def __init__(self, resolver=system_resolver, ttl=60, prefetch=0.8, clock=time.monotonic):
+        if ttl <= 0 or not 0 < prefetch <= 1:
+            raise ValueError("ttl must be positive and prefetch between 0 and 1")
+        self._resolver = resolver
+        self._ttl = ttl
+        self._prefetch = prefetch
+        self._clock = clock
+        self._entries = {}  # host -> _Entry
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a cache from the "dns" section of the configuration."""
+        keys = ("ttl", "prefetch")
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    class _Entry(object):
+        __slots__ = ("addresses", "resolved_at", "ttl", "next", "failed")
+
+        def __init__(self, addresses, resolved_at, ttl):
+            self.addresses = addresses
+            self.resolved_at = resolved_at
+            self.ttl = ttl
+            self.next = 0
+            self.failed = set()
+
+    def _resolve(self, host, port):
+        addresses, ttl = self._resolver(host, port)
+        if not addresses:
+            raise OSError("no addresses for {}".format(host))
+        entry = self._Entry(list(addresses), self._clock(), ttl or self._ttl)
+        with self._lock:
+            self._entries[host] = entry
+        return entry
+
+    def addresses(self, host, port):
+        """Return the addresses to try for `host` in order."""
+        with self._lock:
+            entry = self._entries.get(host)
+        if entry is None:
+            entry = self._resolve(host, port)
+        else:
+            age = self._clock() - entry.resolved_at
+            if age >= entry.ttl:
+                try:
+                    entry = self._resolve(host, port)
+                except OSError as e:
+                    logger.warning("Failed to resolve %s, using old addresses: %s", host, e)
+            elif age >= entry.ttl * self._prefetch:
+                self._prefetch_in_background(host, port)
+
+        with self._lock:
+            start = entry.next
+            entry.next = (start + 1) % len(entry.addresses)
+            ordered = entry.addresses[start:] + entry.addresses[:start]
+            failed = entry.failed
+        if failed:
+            ordered = ([a for a in ordered if a not in failed] +
+                       [a for a in ordered if a in failed])
+        return ordered
+
+    def failed(self, host, address):
+        """Record that connecting to `address` of `host` failed."""
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None:
+                entry.failed.add(address)
+
+    def _prefetch_in_background(self, host, port):
+        with self._lock:
+            if host in self._refreshing:
+                return
+            self._refreshing.add(host)
+        self._spawn(self._refresh, host, port)
+
+    def _refresh(self, host, port):
+        try:
+            self._resolve(host, port)
+        except OSError as e:
+            logger.warning("Failed to prefetch %s: %s", host, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(host)
+
+    @staticmethod
+    def _spawn(target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        """Return a dict describing each cached host."""
+        now = self._clock()
+        with self._lock:
+            return {host: {"addresses": list(entry.addresses),
+                           "failed": sorted(entry.failed),
+                           "expires_in": round(entry.ttl - (now - entry.resolved_at), 3)}
+                    for host, entry in self._entries.items()}
+
+
+class _PinnedConnectionMixin(object):
+    """Connects using the addresses from a `ResolverCache`.
+
+    The host name is still used for the Host header and for TLS.
+    """
+    def __init__(self, *args, resolver, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._resolver_cache = resolver
+        self._create_connection = self._connect_pinned
+
+    def _connect_pinned(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                        source_address=None):
+        host, port = address
+        error = OSError("no addresses for {}".format(host))
+        for ip in self._resolver_cache.addresses(host, port):
+            try:
+                return socket.create_connection((ip, port), timeout, source_address)
+            except OSError as e:
+                logger.info("Failed to connect to %s at %s: %s", host, ip, e)
+                self._resolver_cache.failed(host, ip)
+                error = e
+        raise error
+
+
+class PinnedHTTPConnection(_PinnedConnectionMixin, http.client.HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(_PinnedConnectionMixin, http.client.HTTPSConnection):
+    pass
+
+
+class PinnedHTTPHandler(request.HTTPHandler):
+    def __init__(self, resolver):
+        super().__init__()
+        self._resolver_cache = resolver
+
+    def http_open(self, req):
+        return self.do_open(functools.partial(PinnedHTTPConnection,
+                                              resolver=self._resolver_cache), req)
+
+
+class PinnedHTTPSHandler(request.HTTPSHandler):
+    def __init__(self, resolver):
+        super().__init__()
+        self._resolver_cache = resolver
+
+    def https_open(self, req):
+        return self.do_open(functools.partial(PinnedHTTPSConnection,
+                                              resolver=self._resolver_cache), req,
+                            context=self._context)
+
+
+def build_opener(resolver):
+    """Return a URL opener which connects using `resolver`."""
+    return request.build_opener(PinnedHTTPHandler(resolver), PinnedHTTPSHandler(resolver))
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import io
 import json
 import logging
+import threading
+import time
 from urllib.parse import urlencode
 import urllib.request as request
+import xml.etree.ElementTree as ElementTree
+import zipfile
+
+from geocode.cache import GeocodeCache, FRESH, REFRESH, STALE, EXPIRED
+from geocode.bulkhead import Bulkhead, BulkheadFull
+from geocode.compact import CompactGeocodeCache
+from geocode import dns
+from geocode import tracing
 
 
 logger = logging.getLogger("")
@@ -56,6 +69,7 @@ class GoogleGeocodeService(object):
 class HEREGeocodeService(object):
     """HERE Geocode Service implementation."""
     url = "https://geocoder.api.here.com/6.2/geocode.json"
+    batch_url = "https://batch.geocoder.api.here.com/6.2/jobs"
     required_credentials = ("APP_ID", "APP_CODE")
 
     def prepare(self, credentials, location):
@@ -88,6 +102,93 @@ class HEREGeocodeService(object):
         """Change the default URL."""
         self.url = new_url
 
+    # Batch geocoding. Many locations are uploaded as one job, the job is
+    # polled until it completes and then all results are downloaded.
+    def _batch_params(self, credentials, **params):
+        params.update({"app_id": credentials["APP_ID"],
+                       "app_code": credentials["APP_CODE"]})
+        return urlencode(params)
+
+    def prepare_batch(self, credentials, locations):
+        """Return the URL and body which submit a batch job for `locations`.
+
+        The record ID of each location is its index in `locations`.
+        """
+        params = self._batch_params(credentials, action="run", header="true",
+                                    inDelim="|", outDelim="|", outputcombined="true",
+                                    outCols="navigationLatitude,navigationLongitude")
+        lines = ["recId|searchText"]
+        for rec_id, location in enumerate(locations):
+            text = location.replace("+", " ").replace("|", " ").replace("\n", " ")
+            lines.append("{}|{}".format(rec_id, text))
+        return "{}?{}".format(self.batch_url, params), "\n".join(lines).encode()
+
+    def batch_status_url(self, credentials, job_id):
+        """Return the URL reporting the status of a batch job."""
+        return "{}/{}?{}".format(self.batch_url, job_id,
+                                 self._batch_params(credentials, action="status"))
+
+    def batch_result_url(self, credentials, job_id):
+        """Return the URL to download the results of a batch job."""
+        return "{}/{}/result?{}".format(self.batch_url, job_id,
+                                        self._batch_params(credentials))
+
+    def process_batch_status(self, data):
+        """Process a batch job submit or status response.
+
+        Returns a tuple of the job ID and the job status such as
+        "accepted", "running" or "completed".
+
+        Raises `DataProcessingError` on error.
+        """
+        try:
+            root = ElementTree.fromstring(data)
+        except ElementTree.ParseError:
+            raise DataProcessingError(data)
+        found = {}
+        for element in root.iter():
+            # Ignore namespaces. Only the local names matter.
+            tag = element.tag.rsplit("}", 1)[-1]
+            if tag in ("RequestId", "Status") and tag not in found:
+                found[tag] = (element.text or "").strip()
+        if not found.get("RequestId") or not found.get("Status"):
+            raise DataProcessingError(data)
+        return found["RequestId"], found["Status"].lower()
+
+    def process_batch_result(self, data, count):
+        """Process the downloaded results of a batch job.
+
+        `data` may be the zip archive HERE returns or the text inside
+        it. Returns a list of `count` results in record ID order. A
+        location that was not found has an empty dict.
+
+        Raises `DataProcessingError` on error.
+        """
+        try:
+            if data[:2] == b"PK":
+                with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                    data = archive.read(archive.namelist()[0])
+            lines = data.decode().splitlines()
+            header = lines[0].split("|")
+            rec_col = header.index("recId")
+            lat_col = header.index("navigationLatitude")
+            lng_col = header.index("navigationLongitude")
+            results = [{} for _ in range(count)]
+            for line in lines[1:]:
+                if not line:
+                    continue
+                fields = line.split("|")
+                rec_id = int(fields[rec_col])
+                if fields[lat_col] and fields[lng_col] and not results[rec_id]:
+                    results[rec_id] = {"lat": fields[lat_col], "lng": fields[lng_col]}
+            return results
+        except (zipfile.BadZipFile, UnicodeError, IndexError, ValueError):
+            raise DataProcessingError(data)
+
+    def update_batch_url(self, new_url):
+        """Change the default batch job URL."""
+        self.batch_url = new_url
+
 
 class GeocodeLookup(object):
     """Lookup geo location via services."""
@@ -96,6 +197,10 @@ class GeocodeLookup(object):
         "google": GoogleGeocodeService,
         "HERE": HEREGeocodeService,
     }
+    cache_backends = {
+        "dict": GeocodeCache,
+        "compact": CompactGeocodeCache,
+    }
 
     class Error(Exception):
         """Represents a failure during execution."""
@@ -105,7 +210,8 @@ class GeocodeLookup(object):
         """Represents an error in the configuration."""
         pass
 
-    def __init__(self, config, credentials):
+    def __init__(self, config, credentials, cache=None, tracer=None, resolver=None,
+                 bulkheads=None):
         self._services = OrderedDict()
 
         if "services" not in config:
@@ -124,41 +230,397 @@ class GeocodeLookup(object):
             url = config.get(name, {}).get("url", None)
             if url is not None:
                 self._services[name].update_url(url)
+            batch_url = config.get(name, {}).get("batch_url", None)
+            if batch_url is not None and hasattr(self._services[name], "update_batch_url"):
+                self._services[name].update_batch_url(batch_url)
         if not self._services:
             raise GeocodeLookup.ConfigError("no services provided")
 
         self._credentials = credentials
 
+        batch = config.get("batch", {})
+        # A job is uploaded, polled and downloaded so only pays off for
+        # many locations. Fewer are looked up concurrently one at a time.
+        self._batch_min_size = batch.get("min_size", 100)
+        self._batch_poll_interval = batch.get("poll_interval", 1)
+        self._batch_timeout = batch.get("timeout", 60)
+        self._concurrency = batch.get("concurrency", 8)
+
+        if cache is None and "cache" in config:
+            backend = config["cache"].get("backend", "dict")
+            if backend not in self.cache_backends:
+                raise GeocodeLookup.ConfigError("unknown cache backend: {}".format(backend))
+            try:
+                cache = self.cache_backends[backend].from_config(config["cache"])
+            except (TypeError, ValueError) as e:
+                raise GeocodeLookup.ConfigError("invalid cache configuration: {}".format(e))
+        self._cache = cache
+
+        if tracer is None:
+            try:
+                tracer = tracing.from_config(config.get("tracing", {}))
+            except (TypeError, ValueError, OSError) as e:
+                raise GeocodeLookup.ConfigError("invalid tracing configuration: {}".format(e))
+        self._tracer = tracer
+
+        if resolver is None and "dns" in config:
+            try:
+                resolver = dns.ResolverCache.from_config(config["dns"])
+            except (TypeError, ValueError) as e:
+                raise GeocodeLookup.ConfigError("invalid dns configuration: {}".format(e))
+        self._resolver = resolver
+        self._opener = dns.build_opener(resolver) if resolver is not None else None
+
+        if bulkheads is None:
+            bulkheads = {}
+            settings = config.get("bulkheads", {})
+            for name in self._services:
+                if name not in settings and "default" not in settings:
+                    continue
+                try:
+                    bulkheads[name] = Bulkhead.from_config(
+                        name, settings.get(name, settings.get("default")))
+                except (TypeError, ValueError) as e:
+                    raise GeocodeLookup.ConfigError("invalid bulkhead for {}: {}".format(name, e))
+        self._bulkheads = bulkheads
+
+        self._timeout = config.get("timeout", 10)
+
+        # Refreshes run on a few threads. Entries stored together go stale
+        # together so during an outage refreshes are dropped once
+        # `refresh_queued` are waiting rather than piling up.
+        settings = config.get("cache", {})
+        workers = settings.get("refresh_workers", 4)
+        self._max_refreshes = workers + settings.get("refresh_queued", 64)
+        self._refresh_pool = ThreadPoolExecutor(max_workers=workers,
+                                                thread_name_prefix="refresh")
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @property
+    def resolver(self):
+        return self._resolver
+
+    def bulkhead_stats(self):
+        """Return the occupancy of each service's bulkhead."""
+        return {name: bulkhead.stats() for name, bulkhead in self._bulkheads.items()}
+
+    def _open(self, outbound):
+        """Open `outbound` using the resolver cache if there is one."""
+        if self._opener is None:
+            return request.urlopen(outbound, timeout=self._timeout)
+        return self._opener.open(outbound, timeout=self._timeout)
+
+    def cached(self, location):
+        """Return the cached result for `location` or None.
+
+        Only results which `request` would serve without contacting a
+        service are returned.
+        """
+        if self._cache is None:
+            return None
+        return self._cache.peek(location.replace(" ", "+"))
+
     def request(self, location):
         """Perform the HTTP request for the `location` data.
 
         Returns a dict containing Latitude and Logitude as 'lat' and 'lng' keys.
         Raises GeocodeLookup.Error if no service succeeds.
+
+        When a cache is configured fresh entries are returned directly
+        and stale entries are returned while a refresh runs in the
+        background. If every service fails an expired entry is served
+        rather than raising.
         """
         location = location.replace(" ", "+")
 
+        with self._tracer.start_span("lookup") as span:
+            span.set_attribute("location", location)
+            return self._request(location, span)
+
+    def _request(self, location, span):
+        if self._cache is None:
+            return self._fetch(location)
+
+        cached, state = self._cache.get(location)
+        span.set_attribute("cache.hit", state in (FRESH, REFRESH, STALE))
+        if state is not None:
+            span.set_attribute("cache.state", state)
+        if state == FRESH:
+            return cached
+        elif state in (REFRESH, STALE):
+            self._refresh_in_background(location)
+            return cached
+
+        try:
+            result = self._fetch(location)
+        except GeocodeLookup.Error:
+            if state == EXPIRED:
+                logger.warning("All services failed. Serving expired entry for %s", location)
+                return cached
+            raise
+        self._store(location, result)
+        return result
+
+    def _store(self, location, result):
+        """Cache `result`. A result the cache cannot hold is not cached."""
+        if self._cache is None:
+            return
+        try:
+            self._cache.put(location, result)
+        except ValueError as e:
+            logger.warning("Not caching result for %s: %s", location, e)
+
+    def request_many(self, locations):
+        """Look up every location in `locations`.
+
+        Returns a list of results in the same order as `locations`. Each
+        is what `request` would return except that a location for which
+        every service failed is None rather than raising.
+
+        Locations not answered by the cache are sent to each service in
+        turn. A service with batch support gets them all in one job.
+        Otherwise they are looked up concurrently one at a time. Only
+        locations the service could not answer go on to the next one.
+        """
+        with self._tracer.start_span("lookup.many") as span:
+            span.set_attribute("locations", len(locations))
+            return self._request_many(locations)
+
+    def _request_many(self, locations):
+        keys = [location.replace(" ", "+") for location in locations]
+        answers = {}
+        fallback = {}
+        for key in OrderedDict.fromkeys(keys):
+            if self._cache is None:
+                continue
+            cached, state = self._cache.get(key)
+            if state in (FRESH, REFRESH, STALE):
+                answers[key] = cached
+                if state != FRESH:
+                    self._refresh_in_background(key)
+            elif state == EXPIRED:
+                fallback[key] = cached
+
+        pending = [key for key in OrderedDict.fromkeys(keys) if key not in answers]
+        missing = set()
+        for name, service in self._services.items():
+            if not pending:
+                break
+            results = None
+            if hasattr(service, "prepare_batch") and len(pending) >= self._batch_min_size:
+                results = self._isolated(name, [None] * len(pending),
+                                         self._batch_from, name, service, pending,
+                                         self._tracer.current)
+                if all(result is None for result in results):
+                    logger.info("Batch job on %s failed. Looking up one at a time.", name)
+                    results = None
+            if results is None:
+                results = self._many_from(name, service, pending)
+
+            remaining = []
+            for key, result in zip(pending, results):
+                if result:
+                    answers[key] = result
+                    self._store(key, result)
+                else:
+                    if result is not None:
+                        missing.add(key)
+                    remaining.append(key)
+            pending = remaining
+
+        for key in pending:
+            if key in missing:
+                answers[key] = {}
+                self._store(key, {})
+            elif key in fallback:
+                logger.warning("All services failed. Serving expired entry for %s", key)
+                answers[key] = fallback[key]
+        return [answers.get(key) for key in keys]
+
+    def _fetch(self, location):
+        """Ask each service in turn for `location`, bypassing the cache."""
         missing = False  # is the location not in the services or where there errors
 
         for name, service in self._services.items():
+            result = self._isolated(name, None, self._request_from, name, service, location,
+                                    self._tracer.current)
+            if result:
+                return result
+            elif result is not None:
+                missing = True
+
+        if missing:
+            return {}
+
+        raise GeocodeLookup.Error("All services exhausted!")
+
+    def _isolated(self, name, default, fn, *args):
+        """Call `fn(*args)` in the bulkhead of service `name` if it has one.
+
+        Returns `default` without waiting if the bulkhead is full so the
+        caller can move on to the next service.
+        """
+        bulkhead = self._bulkheads.get(name)
+        if bulkhead is None:
+            return fn(*args)
+        try:
+            future = bulkhead.submit(fn, *args)
+        except BulkheadFull:
+            logger.info("Bulkhead for %s is full. Skipping it.", name)
+            return default
+        return future.result()
+
+    def _request_from(self, name, service, location, parent=None):
+        """Ask one service for `location`.
+
+        Returns the result, an empty dict if the service does not know
+        the location or None if the request failed.
+        """
+        with self._tracer.start_span("provider", parent=parent) as span:
+            span.set_attribute("service", name)
             outbound = service.prepare(self._credentials[name], location)
-            response = request.urlopen(outbound)
+            headers = self._trace_headers(span, parent)
+            if headers:
+                outbound = request.Request(outbound, headers=headers)
+            try:
+                response = self._open(outbound)
+            except OSError as e:
+                logger.info("Request to %s failed: %s", name, e)
+                span.set_error(str(e))
+                return None
+            span.set_attribute("http.status_code", response.code)
             if response.code == 200:
                 try:
-                    result = service.process_response(response.read().decode())
+                    data = response.read()
+                    span.set_attribute("bytes", len(data))
+                    with self._tracer.start_span("parse"):
+                        result = service.process_response(data.decode())
                     if result:
                         return {"location": result, "served_by": name}
-                    missing = True
+                    return {}
+                except (OSError, http.client.HTTPException) as e:
+                    # Timed out or cut off while reading the body.
+                    logger.info("Failed to read response from %s: %s", name, e)
+                    span.set_error(str(e) or type(e).__name__)
                 except UnicodeError:
                     logger.error("Failed to parse input as UTF8")
+                    span.set_error("invalid UTF8")
                 except DataProcessingError as e:
                     logger.info("Failed to read from %s: %s", name, e)
+                    span.set_error("unreadable response")
             else:
-                logger.info("Request to %s did not succeed. %s".format(name, response.code))
-
-        if missing:
+                logger.info("Request to %s did not succeed. %s", name, response.code)
+                span.set_error("HTTP {}".format(response.code))
+            return None
+
+    def _trace_headers(self, span, parent):
+        """Return the headers which pass the trace context of `span` on."""
+        # An unsampled trace still passes its context on.
+        context = span if span.sampled else parent or self._tracer.current
+        if context is None or not context.traceparent:
             return {}
-
-        raise GeocodeLookup.Error("All services exhausted!")
+        return {"traceparent": context.traceparent}
+
+    def _many_from(self, name, service, locations):
+        """Ask one service for each of `locations` concurrently."""
+        # Worker threads do not see this thread's span. Hand it over.
+        parent = self._tracer.current
+        workers = min(self._concurrency, len(locations))
+        bulkhead = self._bulkheads.get(name)
+        if bulkhead is not None:
+            # Any more would only be turned away by the service's bulkhead.
+            workers = min(workers, bulkhead.capacity)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            return list(pool.map(lambda location: self._isolated(name, None,
+                                                                 self._request_from, name,
+                                                                 service, location, parent),
+                                 locations))
+
+    def _batch_from(self, name, service, locations, parent=None):
+        """Ask one service for all of `locations` as a batch job.
+
+        Returns a list of results like `_request_from` would. If the job
+        cannot be run every entry is None.
+        """
+        with self._tracer.start_span("provider.batch", parent=parent) as span:
+            span.set_attribute("service", name)
+            span.set_attribute("locations", len(locations))
+            results = self._run_batch(name, service, locations,
+                                      self._trace_headers(span, parent))
+            if results is None:
+                span.set_error("batch failed")
+                return [None] * len(locations)
+            return results
+
+    def _run_batch(self, name, service, locations, headers):
+        credentials = self._credentials[name]
+        url, body = service.prepare_batch(credentials, locations)
+        submit_headers = dict(headers, **{"Content-Type": "text/plain"})
+        try:
+            response = self._open(request.Request(url, data=body, method="POST",
+                                                  headers=submit_headers))
+            job_id, status = service.process_batch_status(response.read())
+
+            deadline = time.monotonic() + self._batch_timeout
+            while status not in ("completed", "failed", "cancelled", "deleted"):
+                if time.monotonic() >= deadline:
+                    logger.info("Batch job %s on %s timed out", job_id, name)
+                    return None
+                time.sleep(self._batch_poll_interval)
+                response = self._open(request.Request(
+                    service.batch_status_url(credentials, job_id), headers=headers))
+                job_id, status = service.process_batch_status(response.read())
+
+            if status != "completed":
+                logger.info("Batch job %s on %s ended as %s", job_id, name, status)
+                return None
+
+            response = self._open(request.Request(
+                service.batch_result_url(credentials, job_id), headers=headers))
+            results = service.process_batch_result(response.read(), len(locations))
+        except (OSError, http.client.HTTPException) as e:
+            logger.info("Batch request to %s failed: %s", name, e)
+            return None
+        except DataProcessingError as e:
+            logger.info("Failed to read batch from %s: %s", name, e)
+            return None
+        return [{"location": result, "served_by": name} if result else {} for result in results]
+
+    def _refresh_in_background(self, location):
+        """Start a refresh of `location` unless one is already running.
+
+        The refresh is dropped if too many are already waiting.
+        """
+        with self._refresh_lock:
+            if location in self._refreshing:
+                return
+            if len(self._refreshing) >= self._max_refreshes:
+                logger.debug("Too many refreshes waiting. Dropping %s", location)
+                return
+            self._refreshing.add(location)
+        self._spawn(self._refresh, location)
+
+    def _refresh(self, location):
+        try:
+            self._store(location, self._fetch(location))
+        except Exception as e:
+            # The cached entry remains in use. Only log the failure.
+            logger.warning("Background refresh of %s failed: %s", location, e)
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(location)
+
+    def _spawn(self, target, *args):
+        return self._refresh_pool.submit(target, *args)
 
 
 def main(argv):
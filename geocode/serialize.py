@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import csv
+import io
+import json
+from json.encoder import encode_basestring_ascii
+import math
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Return `obj` as JSON bytes using the fastest encoder available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return encode_basestring_ascii(value).encode()
+    return dumps(value)
+
+
+def _coordinates(result):
+    """Return latitude and longitude of `result` as floats. NaN if missing."""
+    if not result:
+        return math.nan, math.nan
+    location = result["location"]
+    return float(location["lat"]), float(location["lng"])
+
+
+class JSONSerializer(object):
+    """The default `{"response": ...}` JSON format.
+
+    Results have a fixed shape so the output is assembled from
+    precomputed fragments and only the values are encoded.
+    """
+    content_type = "application/json; charset=utf-8"
+
+    _empty = b'{"response": {}}'
+    _lat = b'{"response": {"location": {"lat": '
+    _lng = b', "lng": '
+    _served_by = b'}, "served_by": '
+    _end = b'}}'
+
+    def single(self, result):
+        """Serialize the result of one lookup."""
+        if not result:
+            return self._empty
+        try:
+            location = result["location"]
+            if len(result) != 2 or len(location) != 2:
+                raise KeyError
+            return b"".join((self._lat, _encode(location["lat"]),
+                             self._lng, _encode(location["lng"]),
+                             self._served_by, _encode(result["served_by"]),
+                             self._end))
+        except (KeyError, TypeError):
+            return dumps({"response": result})
+
+    def many(self, locations, results):
+        """Serialize the results of a bulk lookup. None marks a failure."""
+        return dumps({"response": results})
+
+
+class CSVSerializer(object):
+    """Comma separated `lat,lng,served_by` rows.
+
+    Bulk results start each row with the requested location. Missing
+    or failed results have empty fields.
+    """
+    content_type = "text/csv; charset=utf-8"
+
+    @staticmethod
+    def _row(result):
+        if not result:
+            return ["", "", ""]
+        location = result["location"]
+        return [location["lat"], location["lng"], result["served_by"]]
+
+    def single(self, result):
+        """Serialize the result of one lookup."""
+        out = io.StringIO()
+        csv.writer(out).writerow(self._row(result))
+        return out.getvalue().encode()
+
+    def many(self, locations, results):
+        """Serialize the results of a bulk lookup. None marks a failure."""
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerows([location] + self._row(result)
+                         for location, result in zip(locations, results))
+        return out.getvalue().encode()
+
+
+class BinarySerializer(object):
+    """Packed little endian doubles.
+
+    A single result is 16 bytes of latitude and longitude. Bulk results
+    are a 4 byte count followed by a pair for each location. Missing or
+    failed results are NaN.
+    """
+    content_type = "application/octet-stream"
+
+    _pair = struct.Struct("<dd")
+    _count = struct.Struct("<I")
+
+    def single(self, result):
+        """Serialize the result of one lookup."""
+        return self._pair.pack(*_coordinates(result))
+
+    def many(self, locations, results):
+        """Serialize the results of a bulk lookup. None marks a failure."""
+        buf = bytearray(self._count.size + self._pair.size * len(results))
+        self._count.pack_into(buf, 0, len(results))
+        offset = self._count.size
+        for result in results:
+            self._pair.pack_into(buf, offset, *_coordinates(result))
+            offset += self._pair.size
+        return bytes(buf)
+
+
+serializers = {
+    "application/json": JSONSerializer(),
+    "text/csv": CSVSerializer(),
+    "application/octet-stream": BinarySerializer(),
+}
+default_serializer = serializers["application/json"]
+
+
+def negotiate(accept):
+    """Return the serializer best matching an HTTP Accept header.
+
+    Falls back to JSON when nothing matches.
+    """
+    if not accept:
+        return default_serializer
+
+    best, best_q = None, 0.0
+    for item in accept.split(","):
+        media, _, params = item.partition(";")
+        media = media.strip().lower()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        serializer = serializers.get(media)
+        if serializer is not None and q > best_q:
+            best, best_q = serializer, q
+    return best or default_serializer
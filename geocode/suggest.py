@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import bisect
+import gc
+import heapq
+import json
+import threading
+
+
+def canonicalize(location):
+    """Return `location` lower cased with `+` and runs of spaces as one space."""
+    return " ".join(location.replace("+", " ").split()).lower()
+
+
+class PrefixIndex(object):
+    """Prefix index of resolved locations for typeahead suggestions.
+
+    Each trie node keeps the `k` most popular locations below it so a
+    query only walks the characters of the prefix. Nodes are only
+    created for the first `max_depth` characters. Longer prefixes match
+    few locations so they are found by binary search over a sorted
+    list of every location instead.
+
+    Popularity only ever increases so a node's list only needs to
+    admit the location which was just counted. Lists are replaced
+    rather than changed so queries do not need the lock. `add_many`
+    instead rebuilds the whole trie once so large loads stay linear.
+    """
+    class _Node(object):
+        __slots__ = ("children", "top")
+
+        def __init__(self):
+            self.children = {}
+            self.top = ()
+
+    def __init__(self, k=10, max_depth=8):
+        if k <= 0 or max_depth <= 0:
+            raise ValueError("k and max_depth must be positive")
+        self._k = k
+        self._max_depth = max_depth
+        self._root = self._Node()
+        self._entries = {}  # canonical -> [display, location, served_by, count]
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create an index from the "suggest" section of the configuration."""
+        keys = ("k", "max_depth")
+        return cls(**{key: config[key] for key in keys if key in config})
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, location, result, count=1):
+        """Count a successful lookup of `location` which returned `result`.
+
+        Results without coordinates are ignored.
+        """
+        with self._lock:
+            counted = self._count(location, result, count)
+            if counted is None:
+                return
+            key, entry, new = counted
+            if new:
+                bisect.insort(self._sorted, key)
+            self._promote(key, entry[3])
+
+    def add_many(self, results):
+        """Count each `(location, result, count)` in `results`.
+
+        The same as calling `add` for each but the trie is rebuilt once
+        at the end. Returns how many were counted.
+        """
+        added = 0
+        with self._lock:
+            for location, result, count in results:
+                if self._count(location, result, count) is not None:
+                    added += 1
+            self._rebuild()
+        return added
+
+    def _count(self, location, result, count):
+        """Update the entry for `location`. Returns `(key, entry, new)` or None."""
+        if not result:
+            return None
+        key = canonicalize(location)
+        if not key:
+            return None
+        entry = self._entries.get(key)
+        new = entry is None
+        if new:
+            entry = [" ".join(location.replace("+", " ").split()),
+                     result["location"], result["served_by"], 0]
+            self._entries[key] = entry
+        else:
+            entry[1] = result["location"]
+            entry[2] = result["served_by"]
+        entry[3] += count
+        return key, entry, new
+
+    def _rebuild(self):
+        """Rebuild the trie and sorted list from every entry."""
+        entries = self._entries
+        k = self._k
+        depth = self._max_depth
+        Node = self._Node
+        root = Node()
+        nodes = [root]
+        # The nodes hold no cycles. Pausing the collector while millions
+        # are allocated halves the time taken.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            # Visiting the most popular first means each node simply
+            # keeps the first `k` locations which reach it.
+            for key in sorted(entries, key=lambda key: (-entries[key][3], key)):
+                node = root
+                for char in key[:depth]:
+                    children = node.children
+                    node = children.get(char)
+                    if node is None:
+                        node = children[char] = Node()
+                        node.top = [key]
+                        nodes.append(node)
+                    elif len(node.top) < k:
+                        node.top.append(key)
+        finally:
+            if collecting:
+                gc.enable()
+        for node in nodes:
+            node.top = tuple(node.top)
+        self._sorted = sorted(entries)
+        self._root = root
+
+    def _promote(self, key, count):
+        entries = self._entries
+        node = self._root
+        for char in key[:self._max_depth]:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = self._Node()
+            node = child
+            top = node.top
+            if key not in top:
+                if len(top) >= self._k and entries[top[-1]][3] >= count:
+                    continue
+            else:
+                top = [other for other in top if other != key]
+            # Only `key` moved so insert it in place rather than sorting.
+            position = len(top)
+            for i, other in enumerate(top):
+                other_count = entries[other][3]
+                if other_count < count or (other_count == count and other > key):
+                    position = i
+                    break
+            top = list(top)
+            top.insert(position, key)
+            node.top = tuple(top[:self._k])
+
+    def suggest(self, prefix, limit=None):
+        """Return up to `limit` of the most popular matches for `prefix`.
+
+        `limit` defaults to k and is never more than k since each trie
+        node only keeps k. Each is a dict of the address, its location,
+        the service which resolved it and its popularity.
+        """
+        query = canonicalize(prefix)
+        limit = min(limit or self._k, self._k)
+        if len(query) > self._max_depth:
+            keys = heapq.nsmallest(limit, self._matching(query),
+                                   key=lambda k: (-self._entries[k][3], k))
+        else:
+            node = self._root
+            for char in query:
+                node = node.children.get(char)
+                if node is None:
+                    return []
+            keys = node.top[:limit]
+        out = []
+        for key in keys:
+            display, location, served_by, count = self._entries[key]
+            out.append({"address": display, "location": location,
+                        "served_by": served_by, "count": count})
+        return out
+
+    def _matching(self, query):
+        keys = self._sorted
+        i = bisect.bisect_left(keys, query)
+        # Another thread may insert while this walks. At worst a key is
+        # seen twice or missed, which is fine for suggestions.
+        seen = set()
+        while i < len(keys) and keys[i].startswith(query):
+            if keys[i] not in seen:
+                seen.add(keys[i])
+                yield keys[i]
+            i += 1
+
+    def snapshot(self):
+        """Return every entry as a list of `(address, location, served_by, count)`."""
+        with self._lock:
+            return [tuple(entry) for entry in self._entries.values()]
+
+    def load(self, entries):
+        """Add the entries returned by `snapshot`. Returns how many were added."""
+        return self.add_many((address, {"location": location, "served_by": served_by}, hits)
+                             for address, location, served_by, hits in entries)
+
+    def save(self, path):
+        """Write a snapshot to `path`. Returns the number of entries."""
+        entries = self.snapshot()
+        with open(path, "w") as fp:
+            json.dump(entries, fp)
+        return len(entries)
+
+    def restore(self, path):
+        """Load a snapshot written by `save`."""
+        with open(path) as fp:
+            return self.load(json.load(fp))
+
+    def stats(self):
+        """Return a dict describing the index."""
+        return {"entries": len(self._entries), "k": self._k}
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger("")
+
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def parse_traceparent(header):
+    """Parse a W3C `traceparent` header.
+
+    Returns a tuple of trace ID, parent span ID and the sampled flag or
+    None if the header is missing or malformed.
+    """
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class _NoopSpan(object):
+    """Stands in for a span when the trace is not sampled."""
+    __slots__ = ()
+
+    sampled = False
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, message):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _UnsampledSpan(_NoopSpan):
+    """Carries the context of a trace which is not sampled.
+
+    While entered it is the current span so the spans started beneath
+    it are `NOOP_SPAN` rather than new traces. Its `traceparent` passes
+    the decision on with the sampled flag cleared.
+    """
+    __slots__ = ("_tracer", "trace_id", "span_id", "_previous")
+
+    def __init__(self, tracer, trace_id, span_id):
+        self._tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self._previous = None
+
+    @property
+    def traceparent(self):
+        return "00-{}-{}-00".format(self.trace_id, self.span_id)
+
+    def __enter__(self):
+        self._previous = self._tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._tracer._pop(self._previous)
+        return False
+
+
+class Span(object):
+    """A timed operation within a trace.
+
+    Use as a context manager. While entered it is the parent of spans
+    started on the same thread.
+    """
+    __slots__ = ("_tracer", "trace_id", "span_id", "parent_id", "name",
+                 "start", "end", "attributes", "status", "message", "_previous")
+
+    sampled = True
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self._tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.status = STATUS_UNSET
+        self.message = None
+        self._previous = None
+
+    @property
+    def traceparent(self):
+        """The `traceparent` header which makes this span the parent."""
+        return "00-{}-{}-01".format(self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = STATUS_ERROR
+        self.message = message
+
+    def __enter__(self):
+        self._previous = self._tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and self.status == STATUS_UNSET:
+            self.set_error("{}: {}".format(exc_type.__name__, exc))
+        self._tracer._pop(self._previous)
+        self.end = time.time_ns()
+        self._tracer._finish(self)
+        return False
+
+
+class Tracer(object):
+    """Creates spans and hands finished ones to `exporter`.
+
+    A new trace is sampled with probability `sample_rate`. Traces
+    started from an inbound `traceparent` follow its sampled flag.
+    Spans beneath an unsampled span are `NOOP_SPAN`. Without an
+    exporter nothing is ever sampled and every span is `NOOP_SPAN`.
+    """
+    def __init__(self, exporter=None, sample_rate=0.0):
+        self._exporter = exporter
+        self._sample_rate = sample_rate if exporter is not None else 0.0
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        """The span entered most recently on this thread."""
+        return getattr(self._local, "span", None)
+
+    def _push(self, span):
+        previous = getattr(self._local, "span", None)
+        self._local.span = span
+        return previous
+
+    def _pop(self, previous):
+        self._local.span = previous
+
+    def _finish(self, span):
+        self._exporter.export(span)
+
+    def close(self):
+        """Write any spans still waiting to be exported."""
+        if self._exporter is not None:
+            self._exporter.close()
+
+    def stats(self):
+        """Return a dict of export counters."""
+        if self._exporter is None:
+            return {"enabled": False}
+        js = {"enabled": True, "sample_rate": self._sample_rate}
+        js.update(self._exporter.stats())
+        return js
+
+    def start_span(self, name, parent=None, traceparent=None, attributes=None):
+        """Return a new span.
+
+        The parent is `parent`, then the current span of this thread,
+        then the span named by `traceparent`. A root span which is not
+        sampled only carries the trace context. Below it every span is
+        `NOOP_SPAN`.
+        """
+        if self._exporter is None:
+            return NOOP_SPAN
+        if parent is None:
+            parent = getattr(self._local, "span", None)
+        if parent is not None:
+            if not parent.sampled:
+                return NOOP_SPAN
+            return Span(self, name, parent.trace_id, parent.span_id, attributes or {})
+
+        inbound = parse_traceparent(traceparent)
+        if inbound is not None:
+            trace_id, parent_id, sampled = inbound
+            if not sampled:
+                return _UnsampledSpan(self, trace_id, parent_id)
+            return Span(self, name, trace_id, parent_id, attributes or {})
+
+        if not self._sample_rate or random.random() >= self._sample_rate:
+            return _UnsampledSpan(self, os.urandom(16).hex(), os.urandom(8).hex())
+        return Span(self, name, os.urandom(16).hex(), None, attributes or {})
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def to_otlp(spans, service_name="geocode"):
+    """Return `spans` as an OTLP/JSON `ExportTraceServiceRequest` dict."""
+    out = []
+    for span in spans:
+        js = {"traceId": span.trace_id,
+              "spanId": span.span_id,
+              "name": span.name,
+              "kind": 1,
+              "startTimeUnixNano": str(span.start),
+              "endTimeUnixNano": str(span.end),
+              "attributes": [_attribute(k, v) for k, v in span.attributes.items()],
+              "status": {"code": span.status}}
+        if span.parent_id:
+            js["parentSpanId"] = span.parent_id
+        if span.message:
+            js["status"]["message"] = span.message
+        out.append(js)
+    resource = {"attributes": [_attribute("service.name", service_name)]}
+    return {"resourceSpans": [{"resource": resource,
+                               "scopeSpans": [{"scope": {"name": "geocode"},
+                                               "spans": out}]}]}
+
+
+class FileSink(object):
+    """Appends each batch to `path` as one line of JSON."""
+    def __init__(self, path):
+        self._path = path
+
+    def write(self, data):
+        with open(self._path, "ab") as fp:
+            fp.write(data + b"\n")
+
+
+class UDPSink(object):
+    """Sends each batch as a datagram to `host`:`port`.
+
+    Batches encoding to more than `max_size` bytes are split by the
+    exporter so each fits in one datagram.
+    """
+    max_size = 60000
+
+    def __init__(self, host, port):
+        self._address = (host, port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, data):
+        self._sock.sendto(data, self._address)
+
+
+class BatchExporter(object):
+    """Queues finished spans and writes them to `sink` in batches.
+
+    A batch is written when `batch_size` spans are waiting or every
+    `flush_interval` seconds. At most `max_queued` spans wait. More are
+    dropped rather than slowing down requests.
+    """
+    def __init__(self, sink, batch_size=256, flush_interval=5.0, max_queued=8192,
+                 service_name="geocode"):
+        self._sink = sink
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._service_name = service_name
+        self._queue = queue.Queue(max_queued)
+        self._dropped = 0
+        self._exported = 0
+        self._thread = None
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._dropped += 1
+
+    def start(self):
+        """Write batches from a background thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self, timeout=5.0):
+        """Stop the background thread and write everything still queued.
+
+        Returns the number of spans written.
+        """
+        if self._thread is not None:
+            try:
+                # Tells the thread to write what it has gathered and stop.
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+        return self.flush()
+
+    def flush(self):
+        """Write everything queued so far. Returns the number of spans written."""
+        written = 0
+        while True:
+            batch = []
+            while len(batch) < self._batch_size:
+                try:
+                    span = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if span is not None:
+                    batch.append(span)
+            if not batch:
+                return written
+            self._write(batch)
+            written += len(batch)
+
+    def _write(self, batch):
+        data = json.dumps(to_otlp(batch, self._service_name)).encode()
+        limit = getattr(self._sink, "max_size", None)
+        if limit is not None and len(data) > limit and len(batch) > 1:
+            half = len(batch) // 2
+            self._write(batch[:half])
+            self._write(batch[half:])
+            return
+        try:
+            self._sink.write(data)
+            self._exported += len(batch)
+        except OSError as e:
+            logger.warning("Failed to export %d spans: %s", len(batch), e)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    span = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+            if batch:
+                self._write(batch)
+
+    def stats(self):
+        """Return a dict of export counters."""
+        return {"queued": self._queue.qsize(),
+                "exported": self._exported,
+                "dropped": self._dropped}
+
+
+def from_config(config):
+    """Create a `Tracer` from the "tracing" section of the configuration.
+
+    The exporter writes to "file" or to the "udp" address given as
+    host:port. Without either, tracing is disabled.
+    """
+    if "file" in config:
+        sink = FileSink(config["file"])
+    elif "udp" in config:
+        host, _, port = config["udp"].rpartition(":")
+        sink = UDPSink(host, int(port))
+    else:
+        return Tracer()
+    exporter = BatchExporter(sink,
+                             batch_size=config.get("batch_size", 256),
+                             flush_interval=config.get("flush_interval", 5.0),
+                             max_queued=config.get("max_queued", 8192),
+                             service_name=config.get("service_name", "geocode"))
+    exporter.start()
+    return Tracer(exporter, config.get("sample_rate", 0.0))
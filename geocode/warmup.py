@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import unquote_plus
+
+
+logger = logging.getLogger("")
+
+# Matches debug lines, raw query strings and the "query" of access records.
+WHERE_RE = re.compile(r"[?&\s\"]where=([^&\s'\"]+)")
+
+
+def save_snapshot(cache, path):
+    """Write the contents of `cache` to `path`.
+
+    Returns the number of entries written.
+    """
+    entries = cache.dump()
+    with open(path, "w") as fp:
+        json.dump({"saved_at": time.time(), "entries": entries}, fp)
+    return len(entries)
+
+
+def load_snapshot(cache, path):
+    """Load a snapshot written by `save_snapshot` into `cache`.
+
+    Entries age by the time that passed since the snapshot was taken.
+    Returns the number of entries loaded.
+    """
+    with open(path) as fp:
+        data = json.load(fp)
+    offset = max(time.time() - data.get("saved_at", time.time()), 0)
+    return cache.load((key, value, age + offset) for key, value, age in data["entries"])
+
+
+def top_addresses_from_log(path, limit):
+    """Return the `limit` most requested locations in an access log."""
+    counts = Counter()
+    with open(path, errors="replace") as fp:
+        for line in fp:
+            match = WHERE_RE.search(line)
+            if match:
+                counts[unquote_plus(match.group(1))] += 1
+    return [where for where, _ in counts.most_common(limit)]
+
+
+def addresses_from_list(path, limit=None):
+    """Return the locations in `path`, one per line."""
+    with open(path) as fp:
+        addresses = [line.strip() for line in fp if line.strip()]
+    return addresses[:limit] if limit is not None else addresses
+
+
+class RateLimiter(object):
+    """Spaces out calls so no more than `rate` happen per second."""
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may proceed."""
+        if not self._interval:
+            return
+        with self._lock:
+            now = self._clock()
+            slot = max(self._next, now)
+            self._next = slot + self._interval
+        if slot > now:
+            self._sleep(slot - now)
+
+
+class Warmup(object):
+    """Fill the lookup cache before traffic is accepted.
+
+    Each of `addresses` is requested through `lookup` using at most
+    `concurrency` threads and no more than `rate` requests per second.
+    """
+    def __init__(self, lookup, addresses, concurrency=4, rate=10):
+        self._lookup = lookup
+        self._addresses = list(addresses)
+        self._concurrency = max(int(concurrency), 1)
+        self._limiter = RateLimiter(rate)
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._failed = 0
+        self._stopped = False
+        self._listener = None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def start(self):
+        """Run the warm-up in a background thread."""
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def wait(self, timeout=None):
+        """Wait for the warm-up to finish. Returns True if it did."""
+        return self._done.wait(timeout)
+
+    def set_listener(self, listener):
+        """Call `listener(address, result)` after each successful lookup."""
+        self._listener = listener
+
+    def stop(self):
+        """Skip any addresses which have not been started yet."""
+        self._stopped = True
+
+    def run(self):
+        """Request every address. Returns once all have been tried."""
+        try:
+            with ThreadPoolExecutor(max_workers=self._concurrency) as pool:
+                for address in self._addresses:
+                    pool.submit(self._warm, address)
+        finally:
+            self._done.set()
+            logger.info("Warm-up finished: %d requested, %d failed",
+                        self._completed, self._failed)
+
+    def _warm(self, address):
+        if self._stopped:
+            return
+        self._limiter.wait()
+        try:
+            result = self._lookup.request(address)
+            if self._listener is not None:
+                self._listener(address, result)
+            failed = 0
+        except Exception as e:
+            logger.info("Warm-up of %s failed: %s", address, e)
+            failed = 1
+        with self._lock:
+            self._completed += 1
+            self._failed += failed
+
+    def stats(self):
+        """Return a dict describing the progress of the warm-up."""
+        return {"done": self.done,
+                "total": len(self._addresses),
+                "completed": self._completed,
+                "failed": self._failed}
@@ -1,16 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+from collections import OrderedDict
 import http
 import json
 import logging
+import logging.handlers
+import socketserver
 import sys
+import time
 import urllib.parse
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer
 
 from geocode.requests import GeocodeLookup
+from geocode import asynclog
+from geocode import serialize
+from geocode.suggest import PrefixIndex
+from geocode import tracing
+from geocode.admission import AdmissionController
+from geocode import warmup
 
 logger = logging.getLogger("")
+access_logger = logging.getLogger("access")
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """Handles each request in its own thread."""
+    daemon_threads = True
 
 
 class Response(object):
@@ -27,12 +43,24 @@ class Response(object):
         self._status = status
         self._data.append(data)
 
-    def as_json(self, data):
+    def as_json(self, data, status=http.HTTPStatus.OK):
         """Response is JSON data."""
-        self._headers = [('Content-type', 'application/json; charset=utf-8')]
-        self._status = http.HTTPStatus.OK
+        self.as_content(data, 'application/json; charset=utf-8', status)
+
+    def as_content(self, data, content_type, status=http.HTTPStatus.OK):
+        """Response is `data` of the given content type."""
+        self._headers = [('Content-type', content_type)]
+        self._status = status
         self._data.append(data)
 
+    @property
+    def status(self):
+        return self._status
+
+    def add_header(self, name, value):
+        """Add a header to the response."""
+        self._headers.append((name, value))
+
     def add_data(self, data):
         """Add data to the response."""
         self._data.append(data)
@@ -119,6 +147,63 @@ class GeocodeApp(object):
     def __init__(self, lookup):
         self._routes = {}
         self._lookup = lookup
+        self._warmup = None
+        self._ready_at = None
+        self._admission = None
+        self._tracer = tracing.Tracer()
+        self._suggestions = None
+        self._stats = OrderedDict()
+
+    @property
+    def warmup(self):
+        return self._warmup
+
+    def set_warmup(self, warmup, time_budget=None):
+        """Track `warmup` so readiness can be reported.
+
+        After `time_budget` seconds the app is ready even if the
+        warm-up is still running.
+        """
+        self._warmup = warmup
+        self._ready_at = time.monotonic() + time_budget if time_budget is not None else None
+
+    def set_admission(self, admission):
+        """Limit concurrent requests using the `AdmissionController`."""
+        self._admission = admission
+        self.add_stats("admission", admission.stats)
+
+    def set_tracer(self, tracer):
+        """Record a span for each request using `tracer`."""
+        self._tracer = tracer
+        self.add_stats("tracing", tracer.stats)
+
+    @property
+    def suggestions(self):
+        return self._suggestions
+
+    def set_suggestions(self, index):
+        """Record successful lookups in the `PrefixIndex` for /suggest."""
+        self._suggestions = index
+        self.add_stats("suggest", index.stats)
+
+    def add_stats(self, name, source):
+        """Report the dict returned by calling `source` on /status."""
+        self._stats[name] = source
+
+    def stats(self):
+        """Return a dict of every registered statistic."""
+        return {name: source() for name, source in self._stats.items()}
+
+    def cached(self, location):
+        """Return the cached result for `location` or None."""
+        return self._lookup.cached(location)
+
+    @property
+    def ready(self):
+        """True once any warm-up has finished or its time budget has passed."""
+        if self._warmup is None or self._warmup.done:
+            return True
+        return self._ready_at is not None and time.monotonic() >= self._ready_at
 
     def lookup(self, location):
         """Find `location` using the lookup object.
@@ -130,9 +215,24 @@ class GeocodeApp(object):
         failure. Instead an empty response is returned.
         """
         try:
-            return self._lookup.request(location)
+            result = self._lookup.request(location)
         except self._lookup.__class__.Error as e:
             raise LookupError(str(e))
+        if self._suggestions is not None:
+            self._suggestions.add(location, result)
+        return result
+
+    def lookup_many(self, locations):
+        """Find all of `locations` using the lookup object.
+
+        Returns a list of results in the same order. A location which
+        could not be looked up is None.
+        """
+        results = self._lookup.request_many(locations)
+        if self._suggestions is not None:
+            for location, result in zip(locations, results):
+                self._suggestions.add(location, result)
+        return results
 
     def add_routes(self, new_routes):
         """Add new support URL routes."""
@@ -155,6 +255,11 @@ class GeocodeApp(object):
         response.as_error(request.path, status=http.HTTPStatus.SERVICE_UNAVAILABLE)
         return response
 
+    def overloaded(self, response, request, retry_after):
+        response.as_error("overloaded", status=http.HTTPStatus.SERVICE_UNAVAILABLE)
+        response.add_header("Retry-After", str(retry_after))
+        return response
+
     def __call__(self, environ, start_response):
         """This is the heart of the WSGI app.
 
@@ -169,34 +274,83 @@ class GeocodeApp(object):
         qs = environ.get("QUERY_STRING", "")
         response = Response(start_response)
 
-        logger.debug("REQUEST_METHOD: %s", method)
-        logger.debug("PATH_INFO: %s", path_info)
-        logger.debug("QUERY_STRING: %s", qs)
+        logger.debug("REQUEST_METHOD: %s PATH_INFO: %s QUERY_STRING: %s", method, path_info, qs)
 
+        start = time.perf_counter()
         request = Request(self, response, environ, method, path_info, qs)
+        with self._tracer.start_span("http.request",
+                                     traceparent=environ.get("HTTP_TRACEPARENT")) as span:
+            span.set_attribute("http.method", method)
+            span.set_attribute("http.target", path_info)
+            result = self._admit(request, method, path_info)
+            if result.status:
+                span.set_attribute("http.status_code", result.status.value)
+        access_logger.info("access", extra={"access": {
+            "method": method,
+            "path": path_info,
+            "query": qs,
+            "status": result.status.value if result.status else None,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+        }})
+        return result
+
+    def _admit(self, request, method, path_info):
+        """Dispatch the request if admission control allows it.
+
+        Handlers with an `admission_bypass` function which returns True
+        for the request skip admission when bypass is enabled. Otherwise
+        a request which cannot be admitted gets Service Unavailable
+        with a Retry-After header.
+        """
+        admission = self._admission
+        if admission is None:
+            return self._dispatch(request, method, path_info)
+
+        if admission.bypass_enabled:
+            handler = self._routes.get(path_info.rstrip('/'))
+            bypass = getattr(handler, "admission_bypass", None)
+            if bypass is not None and bypass(request):
+                admission.bypassed()
+                return self._dispatch(request, method, path_info)
+
+        if not admission.acquire():
+            return self.overloaded(request.response, request, admission.retry_after)
+        try:
+            return self._dispatch(request, method, path_info)
+        finally:
+            admission.release()
+
+    def _dispatch(self, request, method, path_info):
+        """Find the handler for the request and call it."""
         handler = None
         try:
             # drop trailing /. It will interfere with finding the route.
             stripped = path_info.rstrip('/')
             handler = self._routes[stripped]
         except KeyError:
-            return self.not_found(response, request)
+            return self.not_found(request.response, request)
 
         if method not in handler.supported_methods:
-            return self.method_not_allowed(response, request)
+            return self.method_not_allowed(request.response, request)
 
-        result = handler(request)
-        return result
+        return handler(request)
+
+
+def location_is_cached(request):
+    """True if /location can be answered from the cache."""
+    where = request.query_string.get("where")
+    return bool(where) and request.app.cached(where[0].replace("%20", "+")) is not None
 
 
 def handle_location(request):
     """Handle /location requests.
 
     Returns a JSON object containing the coordinates. If the location
-    was not found then the response will be an empty object. Bad Request
-    is returned if the WHERE parameter is not provided. If all services
-    return something other than HTTP OK this function returns
-    Service Unavailable.
+    was not found then the response will be an empty object. CSV or
+    packed binary output is returned instead if the Accept header asks
+    for it. Bad Request is returned if the WHERE parameter is not
+    provided. If all services return something other than HTTP OK this
+    function returns Service Unavailable.
     """
     response = request.response
     qs = request.query_string
@@ -211,17 +365,100 @@ def handle_location(request):
     # Be flexible. Handle spaced input too.
     where = qs["where"][0].replace("%20", "+")
 
+    serializer = serialize.negotiate(request.env.get("HTTP_ACCEPT"))
     try:
         result = app.lookup(where)
-        js = {
-            "response": result
-        }
-        response.as_json(json.dumps(js))
+        response.as_content(serializer.single(result), serializer.content_type)
         return response
     except LookupError as e:
         logger.error("Failed during lookup: %s", e)
         return app.service_unavailable(response, request)
 handle_location.supported_methods = ("GET", )
+handle_location.admission_bypass = location_is_cached
+
+
+def handle_bulk(request):
+    """Handle /bulk requests.
+
+    Every WHERE parameter is looked up. The results are returned in the
+    same order in the format chosen by the Accept header. A location
+    which could not be looked up is null in JSON and has empty or NaN
+    fields in the other formats. Bad Request is returned if no WHERE
+    parameter is provided.
+    """
+    response = request.response
+    app = request.app
+    wheres = [where.replace("%20", "+") for where in request.query_string.get("where", [])]
+    if not wheres:
+        response.add_data(b"missing 'where' in query string")
+        return app.bad_request(response, request)
+
+    serializer = serialize.negotiate(request.env.get("HTTP_ACCEPT"))
+    results = app.lookup_many(wheres)
+    response.as_content(serializer.many(wheres, results), serializer.content_type)
+    return response
+handle_bulk.supported_methods = ("GET", )
+
+
+def handle_suggest(request):
+    """Handle /suggest requests.
+
+    Returns a JSON object listing the most popular previously resolved
+    addresses starting with the Q parameter, with their coordinates.
+    No service is contacted. K optionally limits the number returned.
+    Bad Request is returned if Q is missing or there is no index.
+    """
+    response = request.response
+    app = request.app
+    qs = request.query_string
+    if app.suggestions is None or not qs.get("q"):
+        response.add_data(b"missing 'q' in query string")
+        return app.bad_request(response, request)
+
+    try:
+        limit = int(qs["k"][0]) if qs.get("k") else None
+    except ValueError:
+        limit = 0
+    if limit is not None and limit < 1:
+        response.add_data(b"'k' must be a positive number")
+        return app.bad_request(response, request)
+
+    js = {"response": app.suggestions.suggest(qs["q"][0], limit)}
+    response.as_content(serialize.dumps(js), serialize.default_serializer.content_type)
+    return response
+handle_suggest.supported_methods = ("GET", )
+handle_suggest.admission_bypass = lambda request: True
+
+
+def handle_health(request):
+    """Handle /health requests.
+
+    Returns OK once the service is ready for traffic and Service
+    Unavailable while the cache is still being warmed.
+    """
+    response = request.response
+    app = request.app
+    js = {"ready": app.ready}
+    if app.warmup is not None:
+        js["warmup"] = app.warmup.stats()
+    status = http.HTTPStatus.OK if app.ready else http.HTTPStatus.SERVICE_UNAVAILABLE
+    response.as_json(json.dumps(js), status=status)
+    return response
+handle_health.supported_methods = ("GET", )
+handle_health.admission_bypass = lambda request: True
+
+
+def handle_status(request):
+    """Handle /status requests.
+
+    Returns a JSON object containing the statistics registered with
+    the app such as admission control counters.
+    """
+    response = request.response
+    response.as_json(json.dumps(request.app.stats()))
+    return response
+handle_status.supported_methods = ("GET", )
+handle_status.admission_bypass = lambda request: True
 
 
 def merge_config(args, config):
@@ -239,6 +476,99 @@ def merge_config(args, config):
     return config
 
 
+def prepare_warmup(lookup, config):
+    """Load the cache snapshot and collect the addresses to warm.
+
+    Returns a `Warmup` object or None if there is nothing to warm.
+    """
+    settings = config.get("warmup")
+    if not settings:
+        return None
+    if lookup.cache is None:
+        logger.warning("Warm-up configured without a cache. Skipping.")
+        return None
+
+    snapshot = settings.get("snapshot")
+    if snapshot:
+        try:
+            count = warmup.load_snapshot(lookup.cache, snapshot)
+            logger.info("Loaded %d cache entries from %s", count, snapshot)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Failed to load cache snapshot %s: %s", snapshot, e)
+
+    addresses = []
+    try:
+        if settings.get("addresses"):
+            addresses.extend(warmup.addresses_from_list(settings["addresses"]))
+        if settings.get("access_log"):
+            addresses.extend(warmup.top_addresses_from_log(settings["access_log"],
+                                                           settings.get("top_n", 1000)))
+    except OSError as e:
+        logger.warning("Failed to read warm-up addresses: %s", e)
+
+    # Anything already served by the snapshot does not need a lookup.
+    addresses = [where for where in OrderedDict.fromkeys(addresses)
+                 if lookup.cache.peek(where.replace(" ", "+")) is None]
+    if not addresses:
+        return None
+
+    return warmup.Warmup(lookup, addresses,
+                         concurrency=settings.get("concurrency", 4),
+                         rate=settings.get("rate", 10))
+
+
+def save_snapshot(lookup, config):
+    """Write the cache snapshot named in the warm-up configuration."""
+    snapshot = config.get("warmup", {}).get("snapshot")
+    if not snapshot or lookup.cache is None:
+        return
+    try:
+        count = warmup.save_snapshot(lookup.cache, snapshot)
+        logger.info("Saved %d cache entries to %s", count, snapshot)
+    except OSError as e:
+        logger.error("Failed to save cache snapshot %s: %s", snapshot, e)
+
+
+def prepare_suggestions(lookup, config):
+    """Create the /suggest index.
+
+    It is loaded from the snapshot in the "suggest" section of the
+    configuration if there is one. Otherwise it is seeded from the
+    cache.
+    """
+    settings = config.get("suggest", {})
+    try:
+        index = PrefixIndex.from_config(settings)
+    except (TypeError, ValueError) as e:
+        logger.error("Invalid suggest configuration: %s", e)
+        raise SystemExit(1)
+
+    snapshot = settings.get("snapshot")
+    if snapshot:
+        try:
+            count = index.restore(snapshot)
+            logger.info("Loaded %d suggestions from %s", count, snapshot)
+            return index
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Failed to load suggestions %s: %s", snapshot, e)
+
+    if lookup.cache is not None:
+        index.add_many((key, value, 1) for key, value, _ in lookup.cache.dump())
+    return index
+
+
+def save_suggestions(index, config):
+    """Write the /suggest snapshot named in the configuration."""
+    snapshot = config.get("suggest", {}).get("snapshot")
+    if not snapshot:
+        return
+    try:
+        count = index.save(snapshot)
+        logger.info("Saved %d suggestions to %s", count, snapshot)
+    except OSError as e:
+        logger.error("Failed to save suggestions %s: %s", snapshot, e)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -261,15 +591,46 @@ def main(argv=None):
 
     config = merge_config(args, config)
 
+    try:
+        listener, log_handler = setup_logging(config, args.debug)
+    except ValueError as e:
+        raise SystemExit("Bad logging configuration: {}".format(e))
+    try:
+        run(config, credentials, log_handler)
+    finally:
+        listener.stop()
+
+
+def setup_logging(config, debug=False):
+    """Send log records to the log file from a background thread.
+
+    Request handling only has to put a record on a bounded queue. The
+    "logging" section of the configuration controls the queue size,
+    what happens when it is full and what fraction of debug records
+    are kept.
+
+    Returns the started `QueueListener` and the queue handler.
+    """
+    settings = config.get("logging", {})
     lh = logging.FileHandler(config["log_file"])
-    lh.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+    lh.setFormatter(asynclog.StructuredFormatter("%(asctime)s - %(levelname)s - %(message)s"))
 
-    logger.addHandler(lh)
-    if args.debug:
+    qh = asynclog.BoundedQueueHandler(maxsize=settings.get("queue_size", 10000),
+                                      overflow=settings.get("overflow", asynclog.DROP))
+    qh.addFilter(asynclog.SamplingFilter(settings.get("debug_sample_rate", 1.0)))
+    logger.addHandler(qh)
+    if debug:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
 
+    listener = logging.handlers.QueueListener(qh.queue, lh)
+    listener.start()
+    return listener, qh
+
+
+def run(config, credentials, log_handler=None):
+    """Create the app and serve requests until interrupted."""
     try:
         lookup = GeocodeLookup(config, credentials)
     except GeocodeLookup.ConfigError as e:
@@ -281,18 +642,56 @@ def main(argv=None):
     # method names or decorators allows.
     routes = {
         "/location": handle_location,
+        "/bulk": handle_bulk,
+        "/suggest": handle_suggest,
+        "/health": handle_health,
+        "/status": handle_status,
     }
     app = GeocodeApp(lookup)
     app.add_routes(routes)
+    app.set_tracer(lookup.tracer)
+    if lookup.cache is not None:
+        app.add_stats("cache", lookup.cache.stats)
+    if lookup.resolver is not None:
+        app.add_stats("dns", lookup.resolver.stats)
+    if lookup.bulkhead_stats():
+        app.add_stats("bulkheads", lookup.bulkhead_stats)
+    if log_handler is not None:
+        app.add_stats("logging", log_handler.stats)
+
+    if "admission" in config:
+        try:
+            app.set_admission(AdmissionController.from_config(config["admission"]))
+        except (TypeError, ValueError) as e:
+            logger.error("Invalid admission configuration: %s", e)
+            raise SystemExit(1)
+
+    # Loads the cache snapshot so must come before seeding the index.
+    warm = prepare_warmup(lookup, config)
+    suggestions = prepare_suggestions(lookup, config)
+    app.set_suggestions(suggestions)
 
     try:
-        httpd = make_server('', config.get("port"), app)
+        httpd = make_server('', config.get("port"), app, server_class=ThreadingWSGIServer)
         logger.info("Serving on port %d...", config["port"])
 
+        # /health reports Service Unavailable until the warm-up finishes
+        # or its time budget passes.
+        if warm is not None:
+            warm.set_listener(suggestions.add)
+            app.set_warmup(warm, config["warmup"].get("time_budget", 30))
+            warm.start()
+
         httpd.serve_forever()
     except PermissionError as e:
         logging.error("Failed to start service: %s", e)
         raise SystemExit(1)
+    finally:
+        if warm is not None:
+            warm.stop()
+        lookup.tracer.close()
+        save_snapshot(lookup, config)
+        save_suggestions(suggestions, config)
 
 
 if __name__ == '__main__':
@@ -7,6 +7,16 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 # PEP8 complains here with E402. But they can't be earlier.
 import geocode  # noqa
+import geocode.admission as admission  # noqa
+import geocode.asynclog as asynclog  # noqa
+import geocode.bulkhead as bulkhead  # noqa
+import geocode.cache as cache  # noqa
+import geocode.compact as compact  # noqa
+import geocode.dns as dns  # noqa
 import geocode.requests as requests  # noqa
+import geocode.serialize as serialize  # noqa
+import geocode.suggest as suggest  # noqa
+import geocode.tracing as tracing  # noqa
+import geocode.warmup as warmup  # noqa
 
 import service.geocode_service as service  # noqa
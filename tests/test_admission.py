@@ -0,0 +1,44 @@
+import threading
+import unittest
+
+from .context import admission
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_from_config(self):
+        obj = admission.AdmissionController.from_config({"max_in_flight": 2, "retry_after": 5})
+        self.assertEqual(5, obj.retry_after)
+        self.assertEqual(2, obj.stats()["max_in_flight"])
+
+        with self.assertRaises(ValueError):
+            admission.AdmissionController.from_config({"max_in_flight": 0})
+
+    def test_shed_when_queue_full(self):
+        obj = admission.AdmissionController(max_in_flight=1, max_queued=0)
+        self.assertTrue(obj.acquire())
+        self.assertFalse(obj.acquire())
+        obj.release()
+        self.assertTrue(obj.acquire())
+        stats = obj.stats()
+        self.assertEqual(2, stats["admitted"])
+        self.assertEqual(1, stats["shed"])
+
+    def test_queue_timeout(self):
+        obj = admission.AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=0.01)
+        self.assertTrue(obj.acquire())
+        self.assertFalse(obj.acquire())
+        self.assertEqual(1, obj.stats()["timed_out"])
+        self.assertEqual(0, obj.stats()["queued"])
+
+    def test_queued_then_admitted(self):
+        obj = admission.AdmissionController(max_in_flight=1, max_queued=1, queue_timeout=5)
+        self.assertTrue(obj.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(obj.acquire()))
+        waiter.start()
+        while obj.stats()["queued"] == 0:
+            pass
+        obj.release()
+        waiter.join(5)
+        self.assertEqual([True], results)
+        self.assertEqual(1, obj.stats()["in_flight"])
@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+import unittest
+
+from .context import asynclog
+
+
+def make_record(level=logging.INFO, msg="hello %s", args=("world", ), **extra):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class BoundedQueueHandlerTest(unittest.TestCase):
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            asynclog.BoundedQueueHandler(overflow="explode")
+
+    def test_record_not_formatted(self):
+        handler = asynclog.BoundedQueueHandler(maxsize=2)
+        record = make_record()
+        handler.emit(record)
+        queued = handler.queue.get_nowait()
+        self.assertIs(record, queued)
+        self.assertEqual(("world", ), queued.args)
+
+    def test_drop(self):
+        handler = asynclog.BoundedQueueHandler(maxsize=2, overflow=asynclog.DROP)
+        records = [make_record(args=(i, )) for i in range(3)]
+        for record in records:
+            handler.emit(record)
+        self.assertEqual({"queued": 2, "max_queued": 2, "dropped": 1}, handler.stats())
+        self.assertEqual([0, 1], [handler.queue.get_nowait().args[0] for _ in range(2)])
+
+    def test_drop_oldest(self):
+        handler = asynclog.BoundedQueueHandler(maxsize=2, overflow=asynclog.DROP_OLDEST)
+        for i in range(3):
+            handler.emit(make_record(args=(i, )))
+        self.assertEqual(1, handler.dropped)
+        self.assertEqual([1, 2], [handler.queue.get_nowait().args[0] for _ in range(2)])
+
+    def test_block(self):
+        handler = asynclog.BoundedQueueHandler(maxsize=1, overflow=asynclog.BLOCK)
+        handler.handle(make_record(args=(0, )))
+        thread = threading.Thread(target=handler.handle, args=(make_record(args=(1, )), ),
+                                  daemon=True)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        # The blocked thread must not be holding the handler lock.
+        self.assertTrue(handler.lock.acquire(timeout=1))
+        handler.lock.release()
+
+        self.assertEqual(0, handler.queue.get(timeout=1).args[0])
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, handler.queue.get_nowait().args[0])
+        self.assertEqual(0, handler.dropped)
+
+
+class SamplingFilterTest(unittest.TestCase):
+    def test_sampling(self):
+        sampler = asynclog.SamplingFilter(0.25)
+        kept = [sampler.filter(make_record(logging.DEBUG)) for _ in range(8)]
+        self.assertEqual(2, kept.count(True))
+        self.assertTrue(sampler.filter(make_record(logging.INFO)))
+
+    def test_off(self):
+        sampler = asynclog.SamplingFilter(0)
+        self.assertFalse(sampler.filter(make_record(logging.DEBUG)))
+        self.assertTrue(sampler.filter(make_record(logging.ERROR)))
+
+
+class StructuredFormatterTest(unittest.TestCase):
+    def test_format(self):
+        formatter = asynclog.StructuredFormatter("%(levelname)s - %(message)s")
+        self.assertEqual("INFO - hello world", formatter.format(make_record()))
+
+        line = formatter.format(make_record(access={"path": "/location", "status": 200}))
+        js = json.loads(line)
+        self.assertEqual("access", js["type"])
+        self.assertEqual("/location", js["path"])
+        self.assertEqual(200, js["status"])
@@ -0,0 +1,197 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import threading
+import unittest
+import unittest.mock as mock
+from urllib.parse import urlparse, parse_qs
+import zipfile
+
+from .context import requests, tracing
+from .test_requests import load_HERE_sample
+
+
+STATUS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<ns2:SearchBatch xmlns:ns2="http://www.navteq.com/lbsp/Search-Batch/1">
+  <Response>
+    <MetaInfo><RequestId>{job}</RequestId></MetaInfo>
+    <Status>{status}</Status>
+  </Response>
+</ns2:SearchBatch>"""
+
+KNOWN = {"425 W Randolph Chicago": ("41.88449", "-87.6387699"),
+         "Palace of Fine Arts": ("37.8029", "-122.4484")}
+
+
+class StubBatchServer(HTTPServer):
+    """Speaks enough of the HERE batch job protocol for the tests."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubBatchHandler)
+        self.jobs = {}
+        self.submitted = []
+        self.traceparents = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/jobs".format(self.server_address[1])
+
+
+class StubBatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="application/xml"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.server.traceparents.append(self.headers.get("traceparent"))
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self.server.submitted.append((parse_qs(urlparse(self.path).query), body))
+        job = "job{}".format(len(self.server.jobs))
+        self.server.jobs[job] = {"polls": 0, "body": body}
+        self.reply(STATUS_XML.format(job=job, status="accepted").encode())
+
+    def do_GET(self):
+        self.server.traceparents.append(self.headers.get("traceparent"))
+        parts = urlparse(self.path).path.split("/")
+        job = self.server.jobs[parts[2]]
+        if len(parts) == 3:
+            job["polls"] += 1
+            status = "running" if job["polls"] < 2 else "completed"
+            self.reply(STATUS_XML.format(job=parts[2], status=status).encode())
+            return
+
+        lines = ["recId|SeqNumber|seqLength|navigationLatitude|navigationLongitude"]
+        for record in job["body"].splitlines()[1:]:
+            rec_id, text = record.split("|")
+            if text in KNOWN:
+                lines.append("{}|1|1|{}|{}".format(rec_id, *KNOWN[text]))
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, "w") as archive:
+            archive.writestr("result.txt", "\n".join(lines))
+        self.reply(out.getvalue(), "application/octet-stream")
+
+
+class HEREBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.service = requests.HEREGeocodeService()
+        self.credentials = {"APP_ID": "foo", "APP_CODE": "bar"}
+
+    def test_prepare_batch(self):
+        url, body = self.service.prepare_batch(self.credentials, ["1+Way+There", "A|B"])
+        parsed = urlparse(url)
+        qs = parse_qs(parsed.query)
+        self.assertEqual(["run"], qs["action"])
+        self.assertEqual(["foo"], qs["app_id"])
+        self.assertEqual(b"recId|searchText\n0|1 Way There\n1|A B", body)
+        self.assertTrue(url.startswith(self.service.batch_url))
+
+    def test_process_batch_status(self):
+        self.assertEqual(("abc", "running"),
+                         self.service.process_batch_status(
+                             STATUS_XML.format(job="abc", status="RUNNING").encode()))
+        with self.assertRaises(requests.DataProcessingError):
+            self.service.process_batch_status(b"<Response/>")
+        with self.assertRaises(requests.DataProcessingError):
+            self.service.process_batch_status(b"not xml")
+
+    def test_process_batch_result(self):
+        data = b"recId|SeqNumber|seqLength|navigationLatitude|navigationLongitude\n" \
+               b"1|1|2|1.5|2.5\n1|2|2|9|9\n2|1|1||\n"
+        self.assertEqual([{}, {"lat": "1.5", "lng": "2.5"}, {}],
+                         self.service.process_batch_result(data, 3))
+        with self.assertRaises(requests.DataProcessingError):
+            self.service.process_batch_result(b"nothing|useful\n", 1)
+
+
+class RequestManyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubBatchServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_lookup(self, services, tracer=None):
+        return requests.GeocodeLookup({"services": services,
+                                       "HERE": {"batch_url": self.server.url},
+                                       "batch": {"min_size": 2, "poll_interval": 0.01,
+                                                 "timeout": 5},
+                                       "cache": {}},
+                                      {"HERE": {"APP_ID": "foo", "APP_CODE": "bar"},
+                                       "google": {"APP_KEY": "thing1"}},
+                                      tracer=tracer)
+
+    def test_batch(self):
+        lookup = self.make_lookup(["HERE"])
+        results = lookup.request_many(["425 W Randolph Chicago", "Palace of Fine Arts",
+                                       "Nowhere", "425 W Randolph Chicago"])
+        self.assertEqual([{"location": {"lat": "41.88449", "lng": "-87.6387699"},
+                           "served_by": "HERE"},
+                          {"location": {"lat": "37.8029", "lng": "-122.4484"},
+                           "served_by": "HERE"},
+                          {},
+                          {"location": {"lat": "41.88449", "lng": "-87.6387699"},
+                           "served_by": "HERE"}],
+                         results)
+        # One job with the duplicate removed.
+        self.assertEqual(1, len(self.server.submitted))
+        self.assertEqual(4, len(self.server.submitted[0][1].splitlines()))
+        # Results are cached.
+        self.assertEqual("HERE", lookup.cached("Palace of Fine Arts")["served_by"])
+
+    def test_trace_context_passed_on(self):
+        tracer = tracing.Tracer(mock.MagicMock(), sample_rate=1.0)
+        lookup = self.make_lookup(["HERE"], tracer)
+        with tracer.start_span("http.request") as root:
+            lookup.request_many(["425 W Randolph Chicago", "Palace of Fine Arts"])
+
+        # Submit, two polls and the download.
+        self.assertEqual(4, len(self.server.traceparents))
+        for traceparent in self.server.traceparents:
+            self.assertEqual(root.trace_id, tracing.parse_traceparent(traceparent)[0])
+
+    def test_fallback_to_single_lookups(self):
+        lookup = self.make_lookup(["HERE", "google"])
+        google = mock.MagicMock(code=200)
+        google.read.return_value = b'{"results": [{"geometry": {"location": ' \
+                                   b'{"lat": "1", "lng": "2"}}}]}'
+        with mock.patch('urllib.request.urlopen', side_effect=OSError("down")) as urlopen:
+            # The batch job, then HERE one at a time, then google.
+            urlopen.side_effect = [OSError("down"), OSError("down"), OSError("down"),
+                                   google, google]
+            results = lookup.request_many(["This Old House", "Palace of Fine Arts"])
+        self.assertEqual([{"location": {"lat": "1", "lng": "2"}, "served_by": "google"}] * 2,
+                         results)
+        self.assertEqual(5, urlopen.call_count)
+
+    def test_failed_batch_falls_back_on_same_service(self):
+        lookup = self.make_lookup(["HERE"])
+        single = mock.MagicMock(code=200)
+        single.read.return_value = load_HERE_sample()
+        with mock.patch('urllib.request.urlopen') as urlopen:
+            urlopen.side_effect = [OSError("no batch"), single, single]
+            results = lookup.request_many(["This Old House", "Palace of Fine Arts"])
+        self.assertEqual(["HERE", "HERE"], [result["served_by"] for result in results])
+        self.assertEqual(3, urlopen.call_count)
+
+    def test_small_requests_skip_batch(self):
+        lookup = requests.GeocodeLookup({"services": ["HERE"],
+                                         "HERE": {"batch_url": self.server.url}},
+                                        {"HERE": {"APP_ID": "foo", "APP_CODE": "bar"}})
+        single = mock.MagicMock(code=200)
+        single.read.return_value = load_HERE_sample()
+        with mock.patch('urllib.request.urlopen', return_value=single):
+            results = lookup.request_many(["This Old House", "Palace of Fine Arts"])
+        self.assertEqual(["HERE", "HERE"], [result["served_by"] for result in results])
+        self.assertEqual([], self.server.submitted)
+
+    def test_all_fail(self):
+        lookup = self.make_lookup(["google"])
+        with mock.patch('urllib.request.urlopen', side_effect=OSError("down")):
+            self.assertEqual([None], lookup.request_many(["This Old House"]))
@@ -0,0 +1,96 @@
+import threading
+import unittest
+import unittest.mock as mock
+
+from .context import bulkhead, requests
+from .test_requests import load_google_sample
+
+
+class BulkheadTest(unittest.TestCase):
+    def test_from_config(self):
+        obj = bulkhead.Bulkhead.from_config("HERE", {"max_concurrent": 2, "max_queued": 1})
+        self.assertEqual(2, obj.stats()["max_concurrent"])
+        obj.shutdown()
+
+        with self.assertRaises(ValueError):
+            bulkhead.Bulkhead.from_config("HERE", {"max_concurrent": 0})
+
+    def test_full(self):
+        obj = bulkhead.Bulkhead("HERE", max_concurrent=1, max_queued=1)
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return "slow"
+
+        first = obj.submit(slow)
+        started.wait(5)
+        second = obj.submit(lambda: "queued")
+        with self.assertRaises(bulkhead.BulkheadFull):
+            obj.submit(lambda: "rejected")
+        stats = obj.stats()
+        self.assertEqual(1, stats["active"])
+        self.assertEqual(1, stats["queued"])
+        self.assertEqual(1, stats["rejected"])
+
+        release.set()
+        self.assertEqual("slow", first.result(5))
+        self.assertEqual("queued", second.result(5))
+        self.assertEqual(2, obj.stats()["completed"])
+        obj.shutdown()
+
+
+class LookupBulkheadTest(unittest.TestCase):
+    def make_lookup(self, settings):
+        return requests.GeocodeLookup({"services": ["HERE", "google"], "bulkheads": settings},
+                                      {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"},
+                                       "google": {"APP_KEY": "thing3"}})
+
+    def test_config(self):
+        obj = self.make_lookup({"HERE": {"max_concurrent": 1}})
+        self.assertEqual(["HERE"], list(obj.bulkhead_stats()))
+
+        obj = self.make_lookup({"default": {"max_concurrent": 3}})
+        self.assertEqual(3, obj.bulkhead_stats()["google"]["max_concurrent"])
+
+        with self.assertRaises(requests.GeocodeLookup.ConfigError):
+            self.make_lookup({"HERE": {"max_concurrent": -1}})
+
+    @mock.patch('urllib.request.urlopen')
+    def test_full_bulkhead_skipped(self, urlopen):
+        obj = self.make_lookup({"HERE": {"max_concurrent": 1, "max_queued": 0}})
+        release = threading.Event()
+        started = threading.Event()
+
+        def stuck():
+            started.set()
+            release.wait(5)
+
+        # Occupy HERE's only thread. The lookup must go straight to google.
+        obj._bulkheads["HERE"].submit(stuck)
+        started.wait(5)
+        urlopen.return_value = mock.MagicMock(code=200,
+                                              **{"read.return_value": load_google_sample()})
+        result = obj.request("1600+Amphitheatre+Parkway+Mountain+View+CA")
+        release.set()
+
+        self.assertEqual("google", result["served_by"])
+        self.assertEqual(1, urlopen.call_count)
+        self.assertEqual(1, obj.bulkhead_stats()["HERE"]["rejected"])
+
+    @mock.patch('urllib.request.urlopen')
+    def test_bulk_fits_bulkhead(self, urlopen):
+        obj = requests.GeocodeLookup({"services": ["google"], "batch": {"concurrency": 8},
+                                      "bulkheads": {"google": {"max_concurrent": 2,
+                                                               "max_queued": 0}}},
+                                     {"google": {"APP_KEY": "thing3"}})
+        urlopen.return_value = mock.MagicMock(code=200,
+                                              **{"read.return_value": load_google_sample()})
+
+        results = obj.request_many(["Place {}".format(i) for i in range(6)])
+
+        self.assertEqual(["google"] * 6, [result["served_by"] for result in results])
+        self.assertEqual(0, obj.bulkhead_stats()["google"]["rejected"])
+        self.assertEqual(6, obj.bulkhead_stats()["google"]["completed"])
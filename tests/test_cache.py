@@ -0,0 +1,61 @@
+import unittest
+
+from .context import cache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class GeocodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = cache.GeocodeCache(ttl=100, stale_ttl=50, max_entries=2,
+                                        refresh_ahead=0.2, refresh_min_hits=2,
+                                        clock=self.clock)
+
+    def test_miss(self):
+        self.assertEqual((None, None), self.cache.get("nowhere"))
+
+    def test_states(self):
+        self.cache.put("here", {"a": 1})
+        self.assertEqual(({"a": 1}, cache.FRESH), self.cache.get("here"))
+
+        self.clock.now += 100
+        self.assertEqual(({"a": 1}, cache.STALE), self.cache.get("here"))
+
+        self.clock.now += 50
+        self.assertEqual(({"a": 1}, cache.EXPIRED), self.cache.get("here"))
+        self.assertIsNone(self.cache.peek("here"))
+
+        self.cache.put("here", {"a": 2})
+        self.assertEqual(({"a": 2}, cache.FRESH), self.cache.get("here"))
+
+    def test_refresh_ahead(self):
+        self.cache.put("popular", {"a": 1})
+        self.cache.put("rare", {"b": 1})
+        self.cache.get("popular")
+        self.clock.now += 85
+        self.assertEqual(({"a": 1}, cache.REFRESH), self.cache.get("popular"))
+        # Only one read so far. Not worth refreshing early.
+        self.assertEqual(({"b": 1}, cache.FRESH), self.cache.get("rare"))
+
+    def test_eviction(self):
+        self.cache.put("one", 1)
+        self.cache.put("two", 2)
+        self.cache.get("one")
+        self.cache.put("three", 3)
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual((None, None), self.cache.get("two"))
+        self.assertEqual(1, self.cache.peek("one"))
+
+    def test_from_config(self):
+        obj = cache.GeocodeCache.from_config({"ttl": 10, "max_entries": 5})
+        self.assertEqual({"entries": 0, "max_entries": 5}, obj.stats())
+
+        with self.assertRaises(ValueError):
+            cache.GeocodeCache.from_config({"ttl": 0})
@@ -0,0 +1,74 @@
+import unittest
+
+from .context import cache, compact
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def result(lat, lng, served_by="HERE"):
+    return {"location": {"lat": lat, "lng": lng}, "served_by": served_by}
+
+
+class CompactGeocodeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = compact.CompactGeocodeCache(ttl=100, stale_ttl=50, max_entries=3,
+                                                 refresh_ahead=0.2, refresh_min_hits=2,
+                                                 clock=self.clock)
+
+    def test_round_trip(self):
+        self.cache.put("here", result("41.88449", "-87.6387699"))
+        self.cache.put("there", result("37.4224082", "-122.0856086", "google"))
+        self.cache.put("nowhere", {})
+
+        self.assertEqual((result("41.88449", "-87.6387699"), cache.FRESH),
+                         self.cache.get("here"))
+        self.assertEqual(result("37.4224082", "-122.0856086", "google"),
+                         self.cache.peek("there"))
+        self.assertEqual(({}, cache.FRESH), self.cache.get("nowhere"))
+        self.assertEqual((None, None), self.cache.get("missing"))
+
+    def test_states(self):
+        self.cache.put("here", result("1.5", "2.5"))
+        self.cache.get("here")
+        self.clock.now += 90
+        self.assertEqual(cache.REFRESH, self.cache.get("here")[1])
+        self.clock.now += 10
+        self.assertEqual(cache.STALE, self.cache.get("here")[1])
+        self.clock.now += 50
+        self.assertEqual(cache.EXPIRED, self.cache.get("here")[1])
+        self.assertIsNone(self.cache.peek("here"))
+
+    def test_clock_eviction(self):
+        for key in ("one", "two", "three"):
+            self.cache.put(key, result("1.0", "2.0"))
+        # Every slot is referenced. The hand clears them all and evicts "one".
+        self.cache.put("four", result("3.0", "4.0"))
+        self.assertEqual(3, len(self.cache))
+        self.assertIsNone(self.cache.peek("one"))
+
+        # "two" was read so "three" goes next.
+        self.cache.get("two")
+        self.cache.put("five", result("5.0", "6.0"))
+        self.assertIsNone(self.cache.peek("three"))
+        self.assertEqual(result("1.0", "2.0"), self.cache.peek("two"))
+        self.assertEqual(result("5.0", "6.0"), self.cache.peek("five"))
+
+    def test_bad_value(self):
+        with self.assertRaises(ValueError):
+            self.cache.put("bad", {"served_by": "HERE"})
+        self.assertEqual(0, len(self.cache))
+
+    def test_dump_load(self):
+        self.cache.put("here", result("1.5", "2.5"))
+        self.clock.now += 30
+        other = compact.CompactGeocodeCache(ttl=100, stale_ttl=50, clock=self.clock)
+        self.assertEqual(1, other.load(self.cache.dump()))
+        self.clock.now += 80
+        self.assertEqual((result("1.5", "2.5"), cache.STALE), other.get("here"))
@@ -0,0 +1,120 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import unittest
+import unittest.mock as mock
+
+from .context import dns, requests
+from .test_requests import load_HERE_sample
+
+
+class StubResolver(object):
+    def __init__(self, answers, ttl=None):
+        self.answers = answers
+        self.ttl = ttl
+        self.calls = []
+
+    def __call__(self, host, port):
+        self.calls.append(host)
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer, self.ttl
+
+
+class ResolverCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.MagicMock(return_value=100.0)
+        self.resolver = StubResolver({"geo.example": ["10.0.0.1", "10.0.0.2", "10.0.0.3"]},
+                                     ttl=10)
+        self.cache = dns.ResolverCache(self.resolver, prefetch=0.5, clock=self.clock)
+        self.cache._spawn = lambda target, *args: target(*args)
+
+    def test_cached_and_rotated(self):
+        self.assertEqual(["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                         self.cache.addresses("geo.example", 443))
+        self.assertEqual(["10.0.0.2", "10.0.0.3", "10.0.0.1"],
+                         self.cache.addresses("geo.example", 443))
+        self.assertEqual(1, len(self.resolver.calls))
+
+    def test_failed_address_last(self):
+        self.cache.addresses("geo.example", 443)
+        self.cache.failed("geo.example", "10.0.0.2")
+        self.assertEqual(["10.0.0.3", "10.0.0.1", "10.0.0.2"],
+                         self.cache.addresses("geo.example", 443))
+
+    def test_ttl_and_prefetch(self):
+        self.cache.addresses("geo.example", 443)
+        self.clock.return_value += 4
+        self.cache.addresses("geo.example", 443)
+        self.assertEqual(1, len(self.resolver.calls))
+
+        # Past the prefetch point a refresh runs but the answer is immediate.
+        self.clock.return_value += 2
+        self.cache.addresses("geo.example", 443)
+        self.assertEqual(2, len(self.resolver.calls))
+        self.assertEqual(10, self.cache.stats()["geo.example"]["expires_in"])
+
+        # Expired. Resolved again before answering.
+        self.clock.return_value += 10
+        self.resolver.answers["geo.example"] = ["10.0.0.9"]
+        self.assertEqual(["10.0.0.9"], self.cache.addresses("geo.example", 443))
+
+    def test_resolver_failure(self):
+        self.cache.addresses("geo.example", 443)
+        self.clock.return_value += 20
+        self.resolver.answers["geo.example"] = OSError("SERVFAIL")
+        self.assertEqual(3, len(self.cache.addresses("geo.example", 443)))
+
+        with self.assertRaises(OSError):
+            self.resolver.answers["other.example"] = []
+            self.cache.addresses("other.example", 443)
+
+
+class StubGeocodeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hosts.append(self.headers["Host"])
+        body = load_HERE_sample()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PinnedLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StubGeocodeHandler)
+        self.server.hosts = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request_with_failover(self):
+        port = self.server.server_address[1]
+        # Nothing listens on 127.0.0.2 so the first address is refused.
+        resolver = dns.ResolverCache(StubResolver({"geocoder.example": ["127.0.0.2",
+                                                                        "127.0.0.1"]}))
+        obj = requests.GeocodeLookup(
+            {"services": ["HERE"],
+             "HERE": {"url": "http://geocoder.example:{}/geocode.json".format(port)}},
+            {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}},
+            resolver=resolver)
+
+        result = obj.request("425+W+Randolph+Chicago")
+        self.assertEqual("HERE", result["served_by"])
+        self.assertEqual(["geocoder.example:{}".format(port)], self.server.hosts)
+        self.assertEqual(["127.0.0.2"], resolver.stats()["geocoder.example"]["failed"])
+        self.assertIs(resolver, obj.resolver)
+
+    def test_from_config(self):
+        obj = requests.GeocodeLookup({"services": ["HERE"], "dns": {"ttl": 30}},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}})
+        self.assertIsInstance(obj.resolver, dns.ResolverCache)
+
+        with self.assertRaises(requests.GeocodeLookup.ConfigError):
+            requests.GeocodeLookup({"services": ["HERE"], "dns": {"prefetch": 2}},
+                                   {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}})
@@ -1,10 +1,12 @@
+import http.client
 import json
 import os
 import unittest
 import unittest.mock as mock
+from urllib.error import URLError
 from urllib.parse import urlparse, parse_qs
 
-from .context import requests
+from .context import cache, compact, requests
 
 
 def load_google_sample():
@@ -294,3 +296,130 @@ class GeocodeLookupTests(unittest.TestCase):
                                                    "APP_CODE": "thing2"}})
             result = obj.request("425+W+Randolph+Chicago")
             self.assertEqual(result, None)
+
+
+class GeocodeLookupCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.MagicMock(return_value=1000.0)
+        self.cache = cache.GeocodeCache(ttl=100, stale_ttl=50, clock=self.clock)
+        self.obj = requests.GeocodeLookup({"services": ["HERE"]},
+                                          {"HERE": {"APP_ID": "thing1",
+                                                    "APP_CODE": "thing2"}},
+                                          cache=self.cache)
+        # Run refreshes inline so the tests can observe them.
+        self.obj._spawn = lambda target, *args: target(*args)
+        self.expected = {"location": {"lat": "41.88449", "lng": "-87.6387699"},
+                         "served_by": "HERE"}
+
+    def test_cache_from_config(self):
+        obj = requests.GeocodeLookup({"services": ["HERE"], "cache": {"ttl": 5}},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}})
+        self.assertIsInstance(obj.cache, cache.GeocodeCache)
+
+        with self.assertRaises(requests.GeocodeLookup.ConfigError):
+            requests.GeocodeLookup({"services": ["HERE"], "cache": {"ttl": -1}},
+                                   {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}})
+
+    @mock.patch('urllib.request.urlopen')
+    def test_fresh_hit(self, urlopen):
+        urlopen.return_value = mock.MagicMock(code=200, **{"read.return_value": load_HERE_sample()})
+
+        self.assertEqual(self.expected, self.obj.request("425 W Randolph Chicago"))
+        self.assertEqual(self.expected, self.obj.request("425+W+Randolph+Chicago"))
+        self.assertEqual(1, urlopen.call_count)
+
+    @mock.patch('urllib.request.urlopen')
+    def test_stale_served_and_refreshed(self, urlopen):
+        self.cache.put("425+W+Randolph+Chicago", {"location": {"lat": "1", "lng": "2"},
+                                                  "served_by": "HERE"})
+        self.clock.return_value += 120
+        urlopen.return_value = mock.MagicMock(code=200, **{"read.return_value": load_HERE_sample()})
+
+        result = self.obj.request("425+W+Randolph+Chicago")
+        self.assertEqual({"lat": "1", "lng": "2"}, result["location"])
+        self.assertEqual(1, urlopen.call_count)
+        self.assertEqual((self.expected, cache.FRESH), self.cache.get("425+W+Randolph+Chicago"))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_stale_refresh_failure_keeps_entry(self, urlopen):
+        old = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"}
+        self.cache.put("425+W+Randolph+Chicago", old)
+        self.clock.return_value += 120
+        urlopen.return_value = mock.MagicMock(code=500)
+
+        self.assertEqual(old, self.obj.request("425+W+Randolph+Chicago"))
+        self.assertEqual((old, cache.STALE), self.cache.get("425+W+Randolph+Chicago"))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_expired_served_when_all_services_fail(self, urlopen):
+        old = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"}
+        self.cache.put("425+W+Randolph+Chicago", old)
+        self.clock.return_value += 500
+        urlopen.return_value = mock.MagicMock(code=500)
+
+        self.assertEqual(old, self.obj.request("425+W+Randolph+Chicago"))
+
+        with self.assertRaises(requests.GeocodeLookup.Error):
+            self.obj.request("Somewhere+Else")
+
+    @mock.patch('urllib.request.urlopen')
+    def test_expired_served_when_service_unreachable(self, urlopen):
+        old = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"}
+        self.cache.put("425+W+Randolph+Chicago", old)
+        self.clock.return_value += 500
+        urlopen.side_effect = URLError("connection refused")
+
+        self.assertEqual(old, self.obj.request("425+W+Randolph+Chicago"))
+
+        with self.assertRaises(requests.GeocodeLookup.Error):
+            self.obj.request("Somewhere+Else")
+
+    @mock.patch('urllib.request.urlopen')
+    def test_expired_served_when_read_times_out(self, urlopen):
+        old = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"}
+        self.cache.put("425+W+Randolph+Chicago", old)
+        self.clock.return_value += 500
+        urlopen.return_value = mock.MagicMock(code=200,
+                                              **{"read.side_effect": TimeoutError("timed out")})
+
+        self.assertEqual(old, self.obj.request("425+W+Randolph+Chicago"))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_read_failure_tries_next_service(self, urlopen):
+        obj = requests.GeocodeLookup({"services": ["HERE", "google"]},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"},
+                                      "google": {"APP_KEY": "thing3"}})
+        urlopen.side_effect = [
+            mock.MagicMock(code=200, **{"read.side_effect": http.client.IncompleteRead(b"")}),
+            mock.MagicMock(code=200, **{"read.return_value": load_google_sample()}),
+        ]
+        self.assertEqual("google", obj.request("Somewhere")["served_by"])
+
+    @mock.patch('urllib.request.urlopen')
+    def test_uncacheable_result_still_returned(self, urlopen):
+        obj = requests.GeocodeLookup({"services": ["google"]}, {"google": {"APP_KEY": "thing1"}},
+                                     cache=compact.CompactGeocodeCache(max_entries=10))
+        data = {"results": [{"geometry": {"location": {"lat": "north", "lng": 1.5}}}]}
+        urlopen.return_value = mock.MagicMock(code=200,
+                                              **{"read.return_value": json.dumps(data).encode()})
+
+        self.assertEqual({"location": {"lat": "north", "lng": "1.5"}, "served_by": "google"},
+                         obj.request("Somewhere"))
+        self.assertEqual(0, len(obj.cache))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_refreshes_are_bounded(self, urlopen):
+        obj = requests.GeocodeLookup({"services": ["HERE"],
+                                      "cache": {"refresh_workers": 1, "refresh_queued": 1}},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}},
+                                     cache=self.cache)
+        obj._spawn = mock.MagicMock()
+
+        for location in ("One", "Two", "Three", "One"):
+            obj._refresh_in_background(location)
+        self.assertEqual(2, obj._spawn.call_count)
+
+        urlopen.side_effect = URLError("connection refused")
+        obj._refresh("One")
+        obj._refresh_in_background("Three")
+        self.assertEqual(3, obj._spawn.call_count)
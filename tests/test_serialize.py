@@ -0,0 +1,61 @@
+import json
+import math
+import struct
+import unittest
+import unittest.mock as mock
+
+from .context import serialize
+
+
+RESULT = {"location": {"lat": "41.88449", "lng": "-87.6387699"}, "served_by": "HERE"}
+
+
+class JSONSerializerTest(unittest.TestCase):
+    def test_single_matches_stdlib(self):
+        serializer = serialize.JSONSerializer()
+        self.assertEqual(json.dumps({"response": RESULT}).encode(), serializer.single(RESULT))
+        self.assertEqual(json.dumps({"response": {}}).encode(), serializer.single({}))
+
+        odd = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE", "extra": "é"}
+        self.assertEqual({"response": odd}, json.loads(serializer.single(odd)))
+
+    def test_many(self):
+        serializer = serialize.JSONSerializer()
+        self.assertEqual({"response": [RESULT, {}, None]},
+                         json.loads(serializer.many(["a", "b", "c"], [RESULT, {}, None])))
+
+    @mock.patch.object(serialize, "orjson", None)
+    def test_stdlib_fallback(self):
+        self.assertEqual(b'{"a": 1}', serialize.dumps({"a": 1}))
+
+
+class CSVSerializerTest(unittest.TestCase):
+    def test_rows(self):
+        serializer = serialize.CSVSerializer()
+        self.assertEqual(b"41.88449,-87.6387699,HERE\r\n", serializer.single(RESULT))
+        self.assertEqual(b",,\r\n", serializer.single({}))
+        self.assertEqual(b'"Chicago, IL",41.88449,-87.6387699,HERE\r\nNowhere,,,\r\n',
+                         serializer.many(["Chicago, IL", "Nowhere"], [RESULT, None]))
+
+
+class BinarySerializerTest(unittest.TestCase):
+    def test_pack(self):
+        serializer = serialize.BinarySerializer()
+        self.assertEqual((41.88449, -87.6387699), struct.unpack("<dd", serializer.single(RESULT)))
+
+        data = serializer.many(["a", "b"], [RESULT, {}])
+        self.assertEqual((2, ), struct.unpack_from("<I", data))
+        values = struct.unpack_from("<dddd", data, 4)
+        self.assertEqual((41.88449, -87.6387699), values[:2])
+        self.assertTrue(all(math.isnan(v) for v in values[2:]))
+
+
+class NegotiateTest(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertIs(serialize.default_serializer, serialize.negotiate(None))
+        self.assertIs(serialize.default_serializer, serialize.negotiate("text/html, */*"))
+        self.assertIsInstance(serialize.negotiate("text/csv"), serialize.CSVSerializer)
+        self.assertIsInstance(serialize.negotiate("text/csv;q=0.5, application/octet-stream"),
+                              serialize.BinarySerializer)
+        self.assertIsInstance(serialize.negotiate("application/json;q=0.1, text/csv;q=0.9"),
+                              serialize.CSVSerializer)
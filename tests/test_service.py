@@ -1,9 +1,11 @@
 import http
 import json
+import os
+import tempfile
 import unittest
 import unittest.mock as mock
 
-from .context import requests
+from .context import admission, cache, requests, suggest, tracing
 from .context import service
 
 
@@ -47,6 +49,33 @@ class GeocodeAppTest(unittest.TestCase):
                          response._headers)
         self.assertEqual([json.dumps({"foo": 1}).encode()], list(response))
 
+    def test_request_span(self):
+        exporter = mock.MagicMock()
+        app = service.GeocodeApp(mock.MagicMock())
+        app.add_routes({"/dummy": dummy_handler})
+        app.set_tracer(tracing.Tracer(exporter))
+
+        app({"PATH_INFO": "/dummy", "REQUEST_METHOD": "POST",
+             "HTTP_TRACEPARENT": "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"},
+            mock.MagicMock())
+        span = exporter.export.call_args[0][0]
+        self.assertEqual("0af7651916cd43dd8448eb211c80319c", span.trace_id)
+        self.assertEqual(200, span.attributes["http.status_code"])
+
+    def test_access_log(self):
+        app = service.GeocodeApp(mock.MagicMock())
+        app.add_routes({"/dummy": dummy_handler})
+
+        with self.assertLogs("access", level="INFO") as logs:
+            app({"PATH_INFO": "/dummy", "REQUEST_METHOD": "POST", "QUERY_STRING": "a=1"},
+                mock.MagicMock())
+            app({"PATH_INFO": "/foo"}, mock.MagicMock())
+        first, second = [record.access for record in logs.records]
+        self.assertEqual({"method": "POST", "path": "/dummy", "query": "a=1", "status": 200},
+                         {k: v for k, v in first.items() if k != "duration_ms"})
+        self.assertGreaterEqual(first["duration_ms"], 0)
+        self.assertEqual(404, second["status"])
+
 
 class HandleLocationTest(unittest.TestCase):
     def test_success(self):
@@ -99,3 +128,195 @@ class HandleLocationTest(unittest.TestCase):
         self.assertEqual(http.HTTPStatus.BAD_REQUEST, response._status)
         self.assertEqual([("Content-type", "text/plain; charset=utf-8")],
                          response._headers)
+
+
+class NegotiationTest(unittest.TestCase):
+    data = {"location": {"lat": "111.5", "lng": "222.5"}, "served_by": "HERE"}
+
+    def make_request(self, qs, accept):
+        app = service.GeocodeApp(mock.MagicMock())
+        app._lookup.request.return_value = self.data
+        return service.Request(app, service.Response(mock.MagicMock()),
+                               {"HTTP_ACCEPT": accept}, "GET", "/location", qs)
+
+    def test_location_csv(self):
+        response = service.handle_location(self.make_request("where=Here", "text/csv"))
+        self.assertEqual([("Content-type", "text/csv; charset=utf-8")], response._headers)
+        self.assertEqual([b"111.5,222.5,HERE\r\n"], list(response))
+
+    def test_bulk_binary(self):
+        request = self.make_request("where=Here&where=There", "application/octet-stream")
+        request.app._lookup.request_many.return_value = [self.data, None]
+        response = service.handle_bulk(request)
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.assertEqual([("Content-type", "application/octet-stream")], response._headers)
+        body = b"".join(response)
+        self.assertEqual(4 + 2 * 16, len(body))
+
+    def test_bulk_json(self):
+        request = self.make_request("where=Here&where=There", None)
+        request.app._lookup.request_many.return_value = [self.data, {}]
+        response = service.handle_bulk(request)
+        request.app._lookup.request_many.assert_called_with(["Here", "There"])
+        self.assertEqual({"response": [self.data, {}]},
+                         json.loads(b"".join(response).decode()))
+
+    def test_bulk_missing_where(self):
+        response = service.handle_bulk(self.make_request("", None))
+        self.assertEqual(http.HTTPStatus.BAD_REQUEST, response._status)
+
+
+class HandleHealthTest(unittest.TestCase):
+    def make_request(self, app):
+        return service.Request(app, service.Response(mock.MagicMock()),
+                               mock.MagicMock(), "GET", "/health", "")
+
+    def test_ready_without_warmup(self):
+        response = service.handle_health(self.make_request(service.GeocodeApp(mock.MagicMock())))
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.assertEqual([json.dumps({"ready": True}).encode()], list(response))
+
+    def test_warming(self):
+        app = service.GeocodeApp(mock.MagicMock())
+        warm = mock.MagicMock(done=False)
+        warm.stats.return_value = {"done": False}
+        app.set_warmup(warm)
+
+        response = service.handle_health(self.make_request(app))
+        self.assertEqual(http.HTTPStatus.SERVICE_UNAVAILABLE, response._status)
+        self.assertEqual([('Content-type', 'application/json; charset=utf-8')],
+                         response._headers)
+
+        warm.done = True
+        response = service.handle_health(self.make_request(app))
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+
+    def test_ready_once_budget_passed(self):
+        app = service.GeocodeApp(mock.MagicMock())
+        warm = mock.MagicMock(done=False)
+        warm.stats.return_value = {"done": False}
+        app.set_warmup(warm, time_budget=60)
+        self.assertFalse(app.ready)
+
+        app.set_warmup(warm, time_budget=0)
+        response = service.handle_health(self.make_request(app))
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.assertEqual({"ready": True, "warmup": {"done": False}},
+                         json.loads(b"".join(response)))
+
+
+class PrepareWarmupTest(unittest.TestCase):
+    def test_no_warmup(self):
+        self.assertIsNone(service.prepare_warmup(mock.MagicMock(), {}))
+        self.assertIsNone(service.prepare_warmup(mock.MagicMock(cache=None),
+                                                 {"warmup": {"addresses": "x"}}))
+
+    def test_addresses_and_snapshot(self):
+        lookup = mock.MagicMock(cache=cache.GeocodeCache())
+        lookup.cache.put("Cached+Place", {})
+        with tempfile.TemporaryDirectory() as tmp:
+            addresses = os.path.join(tmp, "addresses.txt")
+            with open(addresses, "w") as fp:
+                fp.write("Cached Place\nThis Old House\nThis Old House\nElsewhere\n")
+            config = {"warmup": {"addresses": addresses,
+                                 "snapshot": os.path.join(tmp, "snapshot.json"),
+                                 "top_n": 2}}
+            warm = service.prepare_warmup(lookup, config)
+            self.assertEqual(2, warm.stats()["total"])
+
+            # top_n only limits what is taken from the access log.
+            access_log = os.path.join(tmp, "wsgi.log")
+            with open(access_log, "w") as fp:
+                fp.write("GET /location?where=Log+One\n" * 2 + "GET /location?where=Log+Two\n")
+            config["warmup"].update({"access_log": access_log, "top_n": 1})
+            warm = service.prepare_warmup(lookup, config)
+            self.assertEqual(["This Old House", "Elsewhere", "Log One"], warm._addresses)
+
+            service.save_snapshot(lookup, config)
+            self.assertTrue(os.path.exists(config["warmup"]["snapshot"]))
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.lookup = mock.MagicMock()
+        self.lookup.cached.return_value = None
+        self.app = service.GeocodeApp(self.lookup)
+        self.app.add_routes({"/dummy": dummy_handler,
+                             "/location": service.handle_location,
+                             "/status": service.handle_status})
+        self.admission = admission.AdmissionController(max_in_flight=1, max_queued=0,
+                                                       retry_after=3)
+        self.app.set_admission(self.admission)
+
+    def test_admitted(self):
+        response = self.app({"PATH_INFO": "/dummy", "REQUEST_METHOD": "POST"}, mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.assertEqual(1, self.admission.stats()["admitted"])
+        self.assertEqual(0, self.admission.stats()["in_flight"])
+
+    def test_shed(self):
+        self.assertTrue(self.admission.acquire())
+        response = self.app({"PATH_INFO": "/dummy", "REQUEST_METHOD": "POST"}, mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.SERVICE_UNAVAILABLE, response._status)
+        self.assertIn(("Retry-After", "3"), response._headers)
+        self.assertEqual(1, self.admission.stats()["shed"])
+
+    def test_cached_bypass(self):
+        self.assertTrue(self.admission.acquire())
+        data = {"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"}
+        self.lookup.cached.return_value = data
+        self.lookup.request.return_value = data
+        response = self.app({"PATH_INFO": "/location", "QUERY_STRING": "where=This+Old+House"},
+                            mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.lookup.cached.assert_called_with("This Old House")
+        self.assertEqual(1, self.admission.stats()["bypassed"])
+
+    def test_status(self):
+        self.assertTrue(self.admission.acquire())
+        response = self.app({"PATH_INFO": "/status"}, mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        js = json.loads(b"".join(response).decode())
+        self.assertEqual(1, js["admission"]["in_flight"])
+
+
+class SuggestTest(unittest.TestCase):
+    def setUp(self):
+        self.lookup = mock.MagicMock()
+        self.app = service.GeocodeApp(self.lookup)
+        self.app.add_routes({"/location": service.handle_location,
+                             "/suggest": service.handle_suggest})
+        self.app.set_suggestions(suggest.PrefixIndex(k=5))
+
+    def test_lookups_feed_suggestions(self):
+        data = {"location": {"lat": "37.8029", "lng": "-122.4484"}, "served_by": "HERE"}
+        self.lookup.request.return_value = data
+        self.app({"PATH_INFO": "/location", "QUERY_STRING": "where=Palace+of+Fine+Arts"},
+                 mock.MagicMock())
+
+        response = self.app({"PATH_INFO": "/suggest", "QUERY_STRING": "q=pal"}, mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.OK, response._status)
+        self.assertEqual({"response": [{"address": "Palace of Fine Arts",
+                                        "location": data["location"],
+                                        "served_by": "HERE", "count": 1}]},
+                         json.loads(b"".join(response).decode()))
+        self.assertEqual(1, self.lookup.request.call_count)
+
+    def test_bad_request(self):
+        response = self.app({"PATH_INFO": "/suggest"}, mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.BAD_REQUEST, response._status)
+        response = self.app({"PATH_INFO": "/suggest", "QUERY_STRING": "q=a&k=x"},
+                            mock.MagicMock())
+        self.assertEqual(http.HTTPStatus.BAD_REQUEST, response._status)
+        for k in ("0", "-1"):
+            response = self.app({"PATH_INFO": "/suggest", "QUERY_STRING": "q=a&k=" + k},
+                                mock.MagicMock())
+            self.assertEqual(http.HTTPStatus.BAD_REQUEST, response._status)
+
+    def test_seeded_from_cache(self):
+        lookup = mock.MagicMock(cache=cache.GeocodeCache())
+        lookup.cache.put("This+Old+House", {"location": {"lat": "1", "lng": "2"},
+                                            "served_by": "google"})
+        lookup.cache.put("Nowhere", {})
+        index = service.prepare_suggestions(lookup, {})
+        self.assertEqual(["This Old House"], [s["address"] for s in index.suggest("this")])
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from .context import suggest
+
+
+def result(lat="1", lng="2", served_by="HERE"):
+    return {"location": {"lat": lat, "lng": lng}, "served_by": served_by}
+
+
+class CanonicalizeTest(unittest.TestCase):
+    def test_canonicalize(self):
+        self.assertEqual("this old house", suggest.canonicalize(" This+Old  House "))
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = suggest.PrefixIndex(k=2, max_depth=8)
+
+    def addresses(self, prefix, limit=None):
+        return [s["address"] for s in self.index.suggest(prefix, limit)]
+
+    def test_ranking(self):
+        self.index.add("Palace of Fine Arts", result(), 1)
+        self.index.add("Palace Hotel", result(), 3)
+        self.index.add("Pier 39", result(), 2)
+        self.index.add("Nowhere", {})
+
+        self.assertEqual(["Palace Hotel", "Pier 39"], self.addresses("p"))
+        self.assertEqual(["Palace Hotel", "Palace of Fine Arts"], self.addresses("PAL"))
+        self.assertEqual(["Palace Hotel"], self.addresses("pal", 1))
+        self.assertEqual([], self.addresses("nowhere"))
+        self.assertEqual([], self.addresses("x"))
+
+    def test_popularity_grows(self):
+        self.index.add("Palace of Fine Arts", result(), 1)
+        self.index.add("Palace Hotel", result(), 2)
+        self.index.add("Pier 39", result(), 3)
+        self.assertEqual(["Pier 39", "Palace Hotel"], self.addresses("p"))
+
+        self.index.add("Palace+of+Fine+Arts", result(lat="5"), 5)
+        self.assertEqual(["Palace of Fine Arts", "Pier 39"], self.addresses("p"))
+        top = self.index.suggest("palace of")[0]
+        self.assertEqual(6, top["count"])
+        self.assertEqual("5", top["location"]["lat"])
+
+    def test_beyond_max_depth(self):
+        self.index.add("Palace of Fine Arts", result(), 1)
+        self.index.add("Palace of Versailles", result(), 2)
+        self.index.add("Palace of Fine Arts 2", result(), 3)
+        self.assertEqual(["Palace of Fine Arts 2", "Palace of Fine Arts"],
+                         self.addresses("palace of f"))
+        self.assertEqual(["Palace of Versailles"], self.addresses("palace of v"))
+        self.assertEqual([], self.addresses("palace of x"))
+
+    def test_limit_capped_at_k(self):
+        for address in ("abcdefghij one", "abcdefghij two", "abcdefghij three"):
+            self.index.add(address, result())
+        # Within max_depth the trie answers, beyond it the sorted list.
+        self.assertEqual(2, len(self.index.suggest("ab", 5)))
+        self.assertEqual(2, len(self.index.suggest("abcdefghij", 5)))
+        self.assertEqual(1, len(self.index.suggest("abcdefghij", 1)))
+
+    def test_add_many(self):
+        added = [("Palace of Fine Arts", 1), ("Palace Hotel", 3), ("Pier 39", 2),
+                 ("Palace of Versailles", 6), ("palace hotel", 4), ("Pier 1", 5)]
+        for address, count in added:
+            self.index.add(address, result(), count)
+        other = suggest.PrefixIndex(k=2, max_depth=8)
+        self.assertEqual(6, other.add_many([(address, result(), count)
+                                            for address, count in added] +
+                                           [("Nowhere", {}, 1)]))
+
+        for prefix in ("p", "pa", "pal", "palace", "palace o", "pi", "pier 1", "palace of f"):
+            self.assertEqual(self.index.suggest(prefix), other.suggest(prefix))
+        self.assertEqual([], other.suggest("nowhere"))
+
+        other.add("Pier 1", result(), 10)
+        self.assertEqual(["Pier 1", "Palace Hotel"], [s["address"] for s in other.suggest("p")])
+
+    def test_snapshot(self):
+        self.index.add("Palace of Fine Arts", result(), 4)
+        self.index.add("Pier 39", result(served_by="google"), 1)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "suggest.json")
+            self.assertEqual(2, self.index.save(path))
+            other = suggest.PrefixIndex(k=2)
+            self.assertEqual(2, other.restore(path))
+        self.assertEqual(self.index.suggest("p"), other.suggest("p"))
+        self.assertEqual({"entries": 2, "k": 2}, other.stats())
@@ -0,0 +1,248 @@
+import json
+import os
+import socket
+import tempfile
+import timeit
+import unittest
+import unittest.mock as mock
+
+from .context import requests, tracing
+from .test_requests import load_HERE_sample
+
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+class ListExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+    def stats(self):
+        return {"exported": len(self.spans)}
+
+
+class ParseTraceparentTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True),
+                         tracing.parse_traceparent(TRACEPARENT))
+        self.assertFalse(tracing.parse_traceparent(TRACEPARENT[:-2] + "00")[2])
+        self.assertIsNone(tracing.parse_traceparent(None))
+        self.assertIsNone(tracing.parse_traceparent("00-xyz-b7ad6b7169203331-01"))
+        self.assertIsNone(tracing.parse_traceparent("00-" + "0" * 32 + "-b7ad6b7169203331-01"))
+
+
+class TracerTest(unittest.TestCase):
+    def test_disabled(self):
+        tracer = tracing.Tracer()
+        self.assertIs(tracing.NOOP_SPAN, tracer.start_span("x", traceparent=TRACEPARENT))
+        self.assertEqual({"enabled": False}, tracer.stats())
+
+    def test_not_sampled(self):
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=0.0)
+        with tracer.start_span("root") as span:
+            self.assertFalse(span.sampled)
+            self.assertIs(span, tracer.current)
+            self.assertIs(tracing.NOOP_SPAN, tracer.start_span("child"))
+        self.assertIsNone(tracer.current)
+        self.assertEqual([], exporter.spans)
+
+    def test_nested_under_unsampled_parent(self):
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        unsampled = TRACEPARENT[:-2] + "00"
+        with tracer.start_span("root", traceparent=unsampled) as root:
+            self.assertEqual(unsampled, root.traceparent)
+            with tracer.start_span("lookup") as lookup:
+                self.assertIs(tracing.NOOP_SPAN, lookup)
+                with tracer.start_span("provider") as provider:
+                    self.assertIs(tracing.NOOP_SPAN, provider)
+            self.assertIs(tracing.NOOP_SPAN, tracer.start_span("provider", parent=root))
+        self.assertEqual([], exporter.spans)
+
+    def test_parent_child(self):
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        with tracer.start_span("root") as root:
+            with tracer.start_span("child") as child:
+                child.set_attribute("service", "HERE")
+            self.assertIs(root, tracer.current)
+        self.assertIsNone(tracer.current)
+
+        self.assertEqual(["child", "root"], [span.name for span in exporter.spans])
+        self.assertEqual(root.trace_id, child.trace_id)
+        self.assertEqual(root.span_id, child.parent_id)
+        self.assertIsNone(root.parent_id)
+        self.assertLessEqual(child.end, root.end)
+
+    def test_inbound_traceparent(self):
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=0.0)
+        with tracer.start_span("root", traceparent=TRACEPARENT) as span:
+            self.assertEqual("0af7651916cd43dd8448eb211c80319c", span.trace_id)
+            self.assertEqual("b7ad6b7169203331", span.parent_id)
+            self.assertTrue(span.traceparent.startswith("00-0af7651916cd43dd8448eb211c80319c-"))
+        span = tracer.start_span("root", traceparent=TRACEPARENT[:-2] + "00")
+        self.assertFalse(span.sampled)
+        self.assertEqual(TRACEPARENT[:-2] + "00", span.traceparent)
+
+    def test_error(self):
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        with self.assertRaises(KeyError):
+            with tracer.start_span("root"):
+                raise KeyError("x")
+        self.assertEqual(tracing.STATUS_ERROR, exporter.spans[0].status)
+
+    def test_noop_overhead(self):
+        tracer = tracing.Tracer()
+
+        def traced():
+            with tracer.start_span("x") as span:
+                span.set_attribute("a", 1)
+
+        per_span = min(timeit.repeat(traced, number=10000, repeat=3)) / 10000
+        self.assertLess(per_span, 20e-6)
+
+
+class ExportTest(unittest.TestCase):
+    def make_spans(self):
+        tracer = tracing.Tracer(ListExporter(), sample_rate=1.0)
+        with tracer.start_span("root") as root:
+            root.set_attribute("cache.hit", True)
+            root.set_attribute("bytes", 10)
+            with tracer.start_span("child"):
+                pass
+        return tracer._exporter.spans
+
+    def test_to_otlp(self):
+        js = tracing.to_otlp(self.make_spans())
+        spans = js["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        child, root = spans
+        self.assertEqual(root["spanId"], child["parentSpanId"])
+        self.assertNotIn("parentSpanId", root)
+        self.assertIn({"key": "cache.hit", "value": {"boolValue": True}}, root["attributes"])
+        self.assertIn({"key": "bytes", "value": {"intValue": "10"}}, root["attributes"])
+
+    def test_file_export(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "spans.json")
+            exporter = tracing.BatchExporter(tracing.FileSink(path), batch_size=1)
+            for span in self.make_spans():
+                exporter.export(span)
+            self.assertEqual(2, exporter.flush())
+            with open(path) as fp:
+                lines = fp.readlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(2, exporter.stats()["exported"])
+
+    def test_close_writes_pending(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "spans.json")
+            exporter = tracing.BatchExporter(tracing.FileSink(path), flush_interval=60)
+            exporter.start()
+            for span in self.make_spans():
+                exporter.export(span)
+            exporter.close()
+            self.assertIsNone(exporter._thread)
+            with open(path) as fp:
+                spans = [span for line in fp
+                         for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+        self.assertEqual(["child", "root"], [span["name"] for span in spans])
+        self.assertEqual(2, exporter.stats()["exported"])
+
+    def test_udp_export(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        try:
+            tracer = tracing.from_config({"udp": "127.0.0.1:{}".format(receiver.getsockname()[1]),
+                                          "sample_rate": 1.0, "flush_interval": 0.01})
+            with tracer.start_span("root"):
+                pass
+            data, _ = receiver.recvfrom(65536)
+        finally:
+            receiver.close()
+        self.assertEqual("root", json.loads(data)["resourceSpans"][0]["scopeSpans"][0]
+                         ["spans"][0]["name"])
+
+    def test_udp_splits_large_batches(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        exporter = tracing.BatchExporter(tracing.UDPSink("127.0.0.1", receiver.getsockname()[1]))
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        for _ in range(64):
+            with tracer.start_span("http.request") as span:
+                span.set_attribute("http.target", "/location")
+                with tracer.start_span("lookup") as span:
+                    span.set_attribute("location", "425+W+Randolph+Chicago")
+                    with tracer.start_span("provider") as span:
+                        span.set_attribute("service", "HERE")
+                        span.set_attribute("http.status_code", 200)
+                        with tracer.start_span("parse"):
+                            pass
+        try:
+            self.assertEqual(256, exporter.flush())
+            received = 0
+            while received < 256:
+                data, _ = receiver.recvfrom(65536)
+                self.assertLessEqual(len(data), tracing.UDPSink.max_size)
+                received += len(json.loads(data)["resourceSpans"][0]["scopeSpans"][0]["spans"])
+        finally:
+            receiver.close()
+        self.assertEqual(256, received)
+        self.assertEqual(256, exporter.stats()["exported"])
+
+    def test_dropped(self):
+        exporter = tracing.BatchExporter(tracing.FileSink(os.devnull), max_queued=1)
+        spans = self.make_spans()
+        exporter.export(spans[0])
+        exporter.export(spans[1])
+        self.assertEqual(1, exporter.stats()["dropped"])
+
+
+class LookupTracingTest(unittest.TestCase):
+    @mock.patch('urllib.request.urlopen')
+    def test_spans_and_propagation(self, urlopen):
+        urlopen.return_value = mock.MagicMock(code=200, **{"read.return_value": load_HERE_sample()})
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=0.0)
+        obj = requests.GeocodeLookup({"services": ["HERE"], "cache": {}},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}},
+                                     tracer=tracer)
+        with tracer.start_span("http.request", traceparent=TRACEPARENT):
+            obj.request("425 W Randolph Chicago")
+
+        parse, provider, lookup, root = exporter.spans
+        self.assertEqual(["parse", "provider", "lookup", "http.request"],
+                         [span.name for span in exporter.spans])
+        self.assertEqual(provider.span_id, parse.parent_id)
+        self.assertEqual(lookup.span_id, provider.parent_id)
+        self.assertEqual(root.span_id, lookup.parent_id)
+        self.assertEqual("HERE", provider.attributes["service"])
+        self.assertEqual(200, provider.attributes["http.status_code"])
+        self.assertFalse(lookup.attributes["cache.hit"])
+
+        outbound = urlopen.call_args[0][0]
+        self.assertEqual(provider.traceparent, outbound.get_header("Traceparent"))
+
+    @mock.patch('urllib.request.urlopen')
+    def test_unsampled_propagation(self, urlopen):
+        urlopen.return_value = mock.MagicMock(code=200, **{"read.return_value": load_HERE_sample()})
+        exporter = ListExporter()
+        tracer = tracing.Tracer(exporter, sample_rate=1.0)
+        obj = requests.GeocodeLookup({"services": ["HERE"]},
+                                     {"HERE": {"APP_ID": "thing1", "APP_CODE": "thing2"}},
+                                     tracer=tracer)
+        unsampled = TRACEPARENT[:-2] + "00"
+        with tracer.start_span("http.request", traceparent=unsampled):
+            obj.request("425 W Randolph Chicago")
+
+        self.assertEqual([], exporter.spans)
+        outbound = urlopen.call_args[0][0]
+        self.assertEqual(unsampled, outbound.get_header("Traceparent"))
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from .context import cache, warmup
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_round_trip(self):
+        source = cache.GeocodeCache()
+        source.put("This+Old+House", {"location": {"lat": "1", "lng": "2"},
+                                      "served_by": "HERE"})
+        source.put("Nowhere", {})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot.json")
+            self.assertEqual(2, warmup.save_snapshot(source, path))
+
+            dest = cache.GeocodeCache()
+            self.assertEqual(2, warmup.load_snapshot(dest, path))
+
+        self.assertEqual({"location": {"lat": "1", "lng": "2"}, "served_by": "HERE"},
+                         dest.peek("This+Old+House"))
+        self.assertEqual({}, dest.peek("Nowhere"))
+
+
+class AddressSourceTest(unittest.TestCase):
+    def test_top_addresses_from_log(self):
+        lines = ["2018-01-31 12:00:00 - DEBUG - QUERY_STRING: where=This+Old+House\n",
+                 "2018-01-31 12:00:01 - DEBUG - QUERY_STRING: where=Palace%20of%20Fine%20Arts\n",
+                 "2018-01-31 12:00:02 - DEBUG - QUERY_STRING: foo=1&where=This+Old+House\n",
+                 "2018-01-31 12:00:03 - INFO - Serving on port 8001...\n",
+                 '{"time": "2018-01-31 12:00:04", "type": "access", "method": "GET", '
+                 '"path": "/location", "query": "where=Palace+of+Fine+Arts", "status": 200}\n',
+                 '{"time": "2018-01-31 12:00:05", "type": "access", "method": "GET", '
+                 '"path": "/location", "query": "where=Palace+of+Fine+Arts", "status": 200}\n']
+        with tempfile.NamedTemporaryFile("w", suffix=".log", delete=False) as fp:
+            fp.writelines(lines)
+        try:
+            self.assertEqual(["Palace of Fine Arts", "This Old House"],
+                             warmup.top_addresses_from_log(fp.name, 10))
+            self.assertEqual(["Palace of Fine Arts"], warmup.top_addresses_from_log(fp.name, 1))
+        finally:
+            os.unlink(fp.name)
+
+    def test_addresses_from_list(self):
+        with tempfile.NamedTemporaryFile("w", delete=False) as fp:
+            fp.write("This Old House\n\n425 W Randolph Chicago\n")
+        try:
+            self.assertEqual(["This Old House", "425 W Randolph Chicago"],
+                             warmup.addresses_from_list(fp.name))
+            self.assertEqual(["This Old House"], warmup.addresses_from_list(fp.name, 1))
+        finally:
+            os.unlink(fp.name)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_spacing(self):
+        clock = mock.MagicMock(return_value=10.0)
+        sleep = mock.MagicMock()
+        limiter = warmup.RateLimiter(4, clock=clock, sleep=sleep)
+        limiter.wait()
+        limiter.wait()
+        limiter.wait()
+        self.assertEqual([mock.call(0.25), mock.call(0.5)], sleep.call_args_list)
+
+
+class WarmupTest(unittest.TestCase):
+    def test_run(self):
+        lookup = mock.MagicMock()
+        lookup.request.side_effect = [{}, Exception("boom"), {}]
+        obj = warmup.Warmup(lookup, ["a", "b", "c"], concurrency=2, rate=0)
+        self.assertFalse(obj.done)
+
+        obj.start()
+        self.assertTrue(obj.wait(5))
+        self.assertEqual({"done": True, "total": 3, "completed": 3, "failed": 1},
+                         obj.stats())
+        self.assertEqual(3, lookup.request.call_count)
+
+    def test_listener_and_stop(self):
+        lookup = mock.MagicMock()
+        lookup.request.return_value = {"served_by": "HERE"}
+        listener = mock.MagicMock()
+        obj = warmup.Warmup(lookup, ["a", "b"], concurrency=1, rate=0)
+        obj.set_listener(listener)
+        obj.run()
+        self.assertEqual([mock.call("a", {"served_by": "HERE"}),
+                          mock.call("b", {"served_by": "HERE"})], listener.call_args_list)
+
+        obj = warmup.Warmup(lookup, ["c"], concurrency=1, rate=0)
+        obj.stop()
+        obj.run()
+        self.assertEqual(2, lookup.request.call_count)